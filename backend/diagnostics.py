@@ -0,0 +1,135 @@
+# ==========================================
+# 🩺 イベントループ遅延モニタとサンプリングプロファイラ
+# ==========================================
+# 非同期ハンドラの中の同期処理 (SQLite・正規表現・大きなJSON・ポリゴン判定など) がループを止めていないかを
+# 本番のまま調べるための道具。どちらも別スレッドから sys._current_frames() でループスレッドのスタックを覗く。
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from typing import Any, Dict, Optional
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    # collapsed形式では ";" が区切り文字なので名前から除く
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+def collapse_stack(frame) -> str:
+    """フレームを根から葉の順に ";" でつないだ1行にする (flamegraph.pl / speedscope 互換)"""
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+class LoopLagMonitor:
+    """ループ上のハートビートと監視スレッドの組。ハートビートが threshold_ms 以上途絶えたら、
+    その瞬間のループスレッドのスタックを記録して警告を出す"""
+    def __init__(self, threshold_ms: float = 250.0, interval_sec: float = 0.05, history: int = 50):
+        self.threshold_sec = threshold_ms / 1000.0
+        self.interval_sec = interval_sec
+        self.stalls: deque = deque(maxlen=history)
+        self.max_lag_ms = 0.0
+        self.stall_count = 0
+        self._last_beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._current: Optional[Dict[str, Any]] = None # 進行中のストール
+        self._stop = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """ループスレッド (lifespan内) から呼ぶ"""
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._task: self._task.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval_sec
+            await asyncio.sleep(self.interval_sec)
+            now = time.monotonic()
+            lag_ms = max(0.0, (now - expected) * 1000)
+            self.max_lag_ms = max(self.max_lag_ms, lag_ms)
+            previous, self._last_beat = self._last_beat, now
+            stall = self._current
+            if stall is not None:
+                # 再開したのでストールの長さを確定する
+                self._current = None
+                stall["duration_ms"] = round((now - previous) * 1000, 1)
+                print(f"🐢 Event loop resumed after {stall['duration_ms']}ms stall")
+
+    def _watch(self):
+        while not self._stop.wait(self.interval_sec):
+            blocked = time.monotonic() - self._last_beat
+            if blocked < self.threshold_sec or self._current is not None: continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None: continue
+            stall = {
+                "at": time.time(), "blocked_ms": round(blocked * 1000, 1), "duration_ms": None,
+                "stack": collapse_stack(frame), "stack_text": "".join(traceback.format_stack(frame)[-8:]),
+            }
+            self.stall_count += 1
+            self.stalls.append(stall)
+            self._current = stall
+            print(f"🐢 Event loop blocked for {stall['blocked_ms']}ms at:\n{stall['stack_text']}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "threshold_ms": self.threshold_sec * 1000, "max_lag_ms": round(self.max_lag_ms, 1),
+            "stall_count": self.stall_count, "in_stall": self._current is not None,
+            "recent_stalls": [{k: v for k, v in s.items() if k != "stack_text"} for s in reversed(self.stalls)],
+        }
+
+class SamplingProfiler:
+    """一定間隔で全スレッド (または指定スレッド) のスタックを採取し、collapsed形式で集計する"""
+    def __init__(self, interval_sec: float = 0.005, thread_id: Optional[int] = None):
+        self.interval_sec = interval_sec
+        self.thread_id = thread_id
+        self.samples: Counter = Counter()
+        self.sample_count = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread: self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval_sec):
+            for tid, frame in sys._current_frames().items():
+                if tid == own or (self.thread_id is not None and tid != self.thread_id): continue
+                if tid not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                self.samples[f"{names.get(tid, tid)};{collapse_stack(frame)}"] += 1
+            self.sample_count += 1
+
+    def collapsed(self) -> str:
+        """「スタック 回数」の行の集まり (多い順)"""
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common()) + "\n"
+
+async def run_profiler(seconds: float, interval_sec: float = 0.005, thread_id: Optional[int] = None) -> SamplingProfiler:
+    """seconds 秒間サンプリングする。待っている間もループは通常どおりリクエストを処理する"""
+    profiler = SamplingProfiler(interval_sec, thread_id)
+    profiler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        await asyncio.to_thread(profiler.stop)
+    return profiler
@@ -0,0 +1,203 @@
+# ==========================================
+# 🌐 地理計算カーネル (距離・近接重複除去・ポリゴン内判定)
+# ==========================================
+# 座標は main.py と同じく [経度, 緯度] の順。
+# スカラー版は少数の点や参照実装として残し、大量の点はNumPyでまとめて計算する。
+# NumPyは起動時間を縮めるため、ベクトル版を初めて使う時 (またはウォームアップ時) に読み込む。
+from __future__ import annotations
+
+import math
+from typing import Dict, List, Optional, Tuple
+
+np = None
+
+def load_numpy():
+    global np
+    if np is None:
+        import numpy
+        np = numpy
+    return np
+
+EARTH_RADIUS_KM = 6371.0
+
+def haversine_distance(coord1, coord2):
+    R = EARTH_RADIUS_KM
+    if not coord1 or not coord2: return float('inf')
+    try:
+        lat1, lon1 = math.radians(coord1[1]), math.radians(coord1[0])
+        lat2, lon2 = math.radians(coord2[1]), math.radians(coord2[0])
+        dlat = lat2 - lat1
+        dlon = lon2 - lon1
+        a = math.sin(dlat / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2)**2
+        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+        return R * c
+    except:
+        return float('inf')
+
+def is_inside_polygon(lat, lng, poly_coords):
+    inside = False
+    j = len(poly_coords) - 1
+    for i in range(len(poly_coords)):
+        xi, yi = poly_coords[i][0], poly_coords[i][1]
+        xj, yj = poly_coords[j][0], poly_coords[j][1]
+
+        intersect = ((yi > lat) != (yj > lat)) and \
+            (lng < (xj - xi) * (lat - yi) / (yj - yi) + xi)
+        if intersect:
+            inside = not inside
+        j = i
+    return inside
+
+def as_coords(points) -> np.ndarray:
+    """[[経度, 緯度], ...] を (N, 2) の float64 配列にする"""
+    load_numpy()
+    arr = np.asarray(points, dtype=np.float64)
+    return arr.reshape(-1, 2)
+
+def haversine_matrix(a, b) -> np.ndarray:
+    """a (N点) と b (M点) の全組み合わせの距離 (km) を (N, M) 行列で返す"""
+    load_numpy()
+    a, b = np.radians(as_coords(a)), np.radians(as_coords(b))
+    lat1, lon1 = a[:, 1:2], a[:, 0:1]
+    lat2, lon2 = b[:, 1][None, :], b[:, 0][None, :]
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0.0, 1.0)))
+
+def haversine_to_point(points, point) -> np.ndarray:
+    """各点から1点までの距離 (km)"""
+    return haversine_matrix(points, [point])[:, 0]
+
+def points_in_polygon(points, polygon) -> np.ndarray:
+    """各点がポリゴン内にあるかの真偽配列 (外接矩形で先に絞ってから交差判定)"""
+    pts = as_coords(points)
+    poly = as_coords(polygon)
+    mask = np.zeros(len(pts), dtype=bool)
+    if len(pts) == 0 or len(poly) < 3: return mask
+    min_xy, max_xy = poly.min(axis=0), poly.max(axis=0)
+    in_box = np.all((pts >= min_xy) & (pts <= max_xy), axis=1)
+    idx = np.nonzero(in_box)[0]
+    if len(idx) == 0: return mask
+    x, y = pts[idx, 0], pts[idx, 1]
+    inside = np.zeros(len(idx), dtype=bool)
+    xj, yj = poly[-1]
+    for xi, yi in poly:
+        if yi != yj:
+            crosses = (yi > y) != (yj > y)
+            x_cross = (xj - xi) * (y - yi) / (yj - yi) + xi
+            inside ^= crosses & (x < x_cross)
+        xj, yj = xi, yi
+    mask[idx] = inside
+    return mask
+
+class ProximityDeduper:
+    """グリッドハッシュで「ほぼ同じ地点」を判定する逐次型の重複除去 (1点あたり近傍9セルのみ確認)"""
+    def __init__(self, threshold_m: float = 50.0):
+        self.threshold_km = threshold_m / 1000.0
+        self.cell_deg = max(threshold_m / 111_195.0, 1e-7)
+        self._cos_ref: Optional[float] = None # 最初の点の緯度で固定する (点ごとの緯度を使うと南北に近い点でセルがずれる)
+        self._cells: Dict[Tuple[int, int], List[Tuple[float, float, float]]] = {}
+
+    def _cell(self, lng: float, lat: float) -> Tuple[int, int]:
+        # 経度方向のセル幅は cell_deg / cos(基準緯度) 度
+        return (math.floor(lng * self._cos_ref / self.cell_deg), math.floor(lat / self.cell_deg))
+
+    def add(self, coord) -> bool:
+        """新しい地点なら登録してTrue、既存の地点の近くならFalse"""
+        lng, lat = float(coord[0]), float(coord[1])
+        cos_lat = math.cos(math.radians(lat))
+        if self._cos_ref is None: self._cos_ref = max(cos_lat, 0.01)
+        cx, cy = self._cell(lng, lat)
+        limit = (self.threshold_km / 111.195) ** 2
+        # 基準より高緯度では閾値が経度方向に複数セルへ広がるので、その分だけ横に広く調べる
+        nx = max(1, math.ceil(self._cos_ref / max(cos_lat, 0.01)))
+        for dx in range(-nx, nx + 1):
+            for dy in (-1, 0, 1):
+                for o_lng, o_lat, o_cos in self._cells.get((cx + dx, cy + dy), ()):
+                    ex = (lng - o_lng) * (cos_lat + o_cos) / 2
+                    ey = lat - o_lat
+                    if ex * ex + ey * ey <= limit: return False
+        self._cells.setdefault((cx, cy), []).append((lng, lat, cos_lat))
+        return True
+
+def dedup_by_proximity(points, threshold_m: float = 50.0) -> List[int]:
+    """threshold_m 以内の近接点を除いた、残す点のインデックス (先勝ち)"""
+    deduper = ProximityDeduper(threshold_m)
+    return [i for i, p in enumerate(as_coords(points).tolist()) if deduper.add(p)]
+
+def point_to_polyline_km(points, line) -> Tuple[np.ndarray, np.ndarray]:
+    """各点から折れ線までの最短距離 (km) と、最近点の折れ線上の位置 (始点からのkm) を返す。
+    都市スケールの距離なので、基準緯度で平面近似して計算する。"""
+    load_numpy()
+    pts, ln = as_coords(points), as_coords(line)
+    if len(pts) == 0: return np.zeros(0), np.zeros(0)
+    if len(ln) == 1: return haversine_to_point(pts, ln[0]), np.zeros(len(pts))
+    k_lat = 111.195
+    k_lng = k_lat * math.cos(math.radians(float(ln[:, 1].mean())))
+    scale = np.array([k_lng, k_lat])
+    p = pts * scale
+    a, b = ln[:-1] * scale, ln[1:] * scale
+    ab = b - a
+    seg_len = np.hypot(ab[:, 0], ab[:, 1])
+    cum = np.concatenate([[0.0], np.cumsum(seg_len)[:-1]])
+    ap = p[:, None, :] - a[None, :, :]
+    denom = np.where(seg_len > 0, seg_len ** 2, 1.0)
+    t = np.clip((ap * ab[None, :, :]).sum(axis=2) / denom, 0.0, 1.0)
+    nearest = a[None, :, :] + t[:, :, None] * ab[None, :, :]
+    d = np.hypot(*(p[:, None, :] - nearest).transpose(2, 0, 1))
+    best = d.argmin(axis=1)
+    rows = np.arange(len(pts))
+    return d[rows, best], cum[best] + t[rows, best] * seg_len[best]
+
+def sample_polyline(line, spacing_km: float) -> Tuple[np.ndarray, float]:
+    """折れ線を始点から spacing_km ごとに区切った点 (終点を含む) と、折れ線の全長 (km) を返す"""
+    load_numpy()
+    ln = as_coords(line)
+    if len(ln) < 2: return ln.copy(), 0.0
+    k_lat = 111.195
+    k_lng = k_lat * math.cos(math.radians(float(ln[:, 1].mean())))
+    seg = np.diff(ln, axis=0) * np.array([k_lng, k_lat])
+    cum = np.concatenate([[0.0], np.cumsum(np.hypot(seg[:, 0], seg[:, 1]))])
+    total = float(cum[-1])
+    if total == 0: return ln[:1].copy(), 0.0
+    n = max(1, math.ceil(total / max(spacing_km, 1e-6)))
+    targets = np.linspace(0.0, total, n + 1)
+    return np.column_stack([np.interp(targets, cum, ln[:, 0]), np.interp(targets, cum, ln[:, 1])]), total
+
+if __name__ == "__main__":
+    # 参照実装 (スカラー版) との一致確認とスループット計測: python geo.py
+    import time
+    load_numpy()
+    rng = np.random.default_rng(0)
+    poly = [[139.70, 35.65], [139.80, 35.64], [139.82, 35.72], [139.75, 35.75], [139.69, 35.70]]
+    center = [139.76, 35.68]
+    for n in (10, 1_000, 100_000):
+        pts = np.column_stack([rng.uniform(139.6, 139.9, n), rng.uniform(35.6, 35.8, n)])
+        plist = pts.tolist()
+
+        t0 = time.perf_counter(); ref_d = [haversine_distance(p, center) for p in plist]; t1 = time.perf_counter()
+        vec_d = haversine_to_point(pts, center); t2 = time.perf_counter()
+        assert np.allclose(ref_d, vec_d, atol=1e-9)
+
+        t3 = time.perf_counter(); ref_in = [is_inside_polygon(p[1], p[0], poly) for p in plist]; t4 = time.perf_counter()
+        vec_in = points_in_polygon(pts, poly); t5 = time.perf_counter()
+        assert (np.array(ref_in) == vec_in).all()
+
+        t6 = time.perf_counter(); kept = dedup_by_proximity(pts, 50.0); t7 = time.perf_counter()
+        if n <= 1_000:
+            dm = haversine_matrix(pts[kept], pts[kept]); np.fill_diagonal(dm, np.inf)
+            assert dm.min() > 0.05
+
+        print(f"n={n:>7}: haversine {1e3*(t1-t0):8.2f}ms -> {1e3*(t2-t1):7.2f}ms | "
+              f"polygon {1e3*(t4-t3):8.2f}ms -> {1e3*(t5-t4):7.2f}ms | dedup {1e3*(t7-t6):7.2f}ms (kept {len(kept)})")
+
+    # 既知の近接ペア (南北・東西・斜め) は必ず2点目が落ちる。南北に近い点でもセルの境界でずれないこと
+    for a, b in (([140.0, 35.0], [140.0, 35.0002]), ([140.0, 35.0], [140.0002, 35.0]), ([139.99991, 43.00001], [140.00009, 42.99991])):
+        assert haversine_distance(a, b) < 0.025 and dedup_by_proximity([a, b], 30.0) == [0], (a, b)
+    # 30m閾値で25m未満のランダムなペアはすべて重複とみなす
+    for _ in range(20_000):
+        lng, lat = rng.uniform(122, 146), rng.uniform(24, 46)
+        ang, dist = rng.uniform(0, 2 * math.pi), rng.uniform(0, 0.025)
+        b = [lng + dist * math.cos(ang) / (111.195 * math.cos(math.radians(lat))), lat + dist * math.sin(ang) / 111.195]
+        assert dedup_by_proximity([[lng, lat], b], 30.0) == [0], ([lng, lat], b)
+    # 基準緯度 (最初の点) から離れた高緯度でも近接ペアを取りこぼさない
+    assert dedup_by_proximity([[124.0, 24.0], [141.35, 43.06], [141.3503, 43.0601]], 30.0) == [0, 1]
@@ -1,23 +1,38 @@
-from fastapi import FastAPI, HTTPException
+import time
+_IMPORT_STARTED = time.perf_counter() # 起動時間の計測用 (/ready で報告)
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from pydantic import BaseModel, field_validator
-from typing import Optional, List, Any, Dict, Union
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field, field_validator, create_model, ValidationError
+from typing import Optional, List, Any, Dict, Union, Tuple
 import os
 import json
 import urllib.parse
 import asyncio
 import httpx 
 from dotenv import load_dotenv
-from openai import AsyncOpenAI 
 import math
 import re 
 import traceback
 from datetime import date, timedelta 
 import random 
 from contextlib import asynccontextmanager
+from geo import haversine_distance, is_inside_polygon, haversine_to_point, points_in_polygon, ProximityDeduper, load_numpy, point_to_polyline_km, sample_polyline
+from diagnostics import LoopLagMonitor, run_profiler
 import sqlite3
 import hashlib
+import hmac
+import threading
+import bisect
+import unicodedata
+from collections import defaultdict, OrderedDict, deque
+import zlib
+import gzip
+import orjson
+import base64
+import io
+import inspect
 
 load_dotenv()
 
@@ -28,8 +43,117 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MAPBOX_ACCESS_TOKEN = os.getenv("MAPBOX_ACCESS_TOKEN")
 GEOAPIFY_API_KEY = os.getenv("GEOAPIFY_API_KEY")
 RAKUTEN_APP_ID = os.getenv("RAKUTEN_APP_ID")
+# 楽天APIへの秒間リクエスト数 (全エンドポイント共有の予算)
+RAKUTEN_RATE_PER_SEC = float(os.getenv("RAKUTEN_RATE_PER_SEC", "2"))
+RAKUTEN_RATE_BURST = int(os.getenv("RAKUTEN_RATE_BURST", "2"))
+PRICE_CALENDAR_MAX_DAYS = 31
+PRICE_CALENDAR_CONCURRENCY = 4
+BULK_IMPORT_MAX_ITEMS = 60
+BATCH_AVAILABILITY_MAX_HOTELS = 60
 
 HOTPEPPER_API_KEY = os.getenv("HOTPEPPER_API_KEY")
+# ホットペッパー検索のキャッシュは緯度経度をこの格子 (約1km) に丸めて共有する
+HOTPEPPER_GRID_DEG = 0.01
+HOTPEPPER_FETCH_COUNT = 50
+
+# 地名タイプアヘッド: ローカル索引でこの件数以上見つかれば外部APIを呼ばない
+PLACE_TYPEAHEAD_MIN_RESULTS = 3
+PLACE_INDEX_MAX_CANDIDATES = 200
+
+# 周辺スポット: Geoapifyから取得済みの範囲はこのグリッド単位で記録し、期限内はローカルで答える
+POI_GRID_DEG = 0.01
+POI_COVERAGE_TTL_SEC = 30 * 24 * 3600
+POI_FETCH_LIMIT = 100
+# 取得はセル単位。1セルにつき offset で最大 POI_FETCH_MAX_PAGES ページまで読み、最後まで読めたセルだけ取得済みにする
+POI_FETCH_MAX_PAGES = 5
+POI_FETCH_CONCURRENCY = 4
+# 同じ場所 (グリッドに丸めた中心) の周辺スポットのレスポンスを使い回す期間
+NEARBY_CACHE_TTL_SEC = 10 * 60
+
+# 切断されたAI提案ストリームを再開できる期間 (最後まで流し終えた記録はすぐ消す)
+SUGGEST_RESUME_TTL_SEC = 10 * 60
+
+# AI提案スポットの重複判定距離
+SUGGEST_DEDUP_METERS = 30
+
+# スポット詳細: ローカルPOIストアで同名スポットを探す半径と、部分一致を同名とみなす条件
+# (短い方の名前が SPOT_INFO_MATCH_MIN_LEN 文字以上で、長い方の SPOT_INFO_MATCH_MIN_RATIO 以上の長さ)
+SPOT_INFO_LOCAL_RADIUS_M = 150
+SPOT_INFO_MATCH_MIN_LEN = 4
+SPOT_INFO_MATCH_MIN_RATIO = 0.6
+
+# この大きさ未満のレスポンスは圧縮しない (1パケットに収まる程度)
+RESPONSE_COMPRESS_MIN_BYTES = 1400
+
+# 起動時の読み込みを軽くするため、ホットキャッシュに載せるのは最近のエントリのみ
+HOT_CACHE_MAX_BYTES = int(os.getenv("HOT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+HOT_CACHE_PRELOAD_ROWS = int(os.getenv("HOT_CACHE_PRELOAD_ROWS", "2000"))
+
+# stale-while-revalidate の鮮度 (秒)。これを過ぎたエントリは返しつつ裏で更新する
+VACANT_FRESH_SEC = 30 * 60
+AVAILABILITY_FRESH_SEC = 30 * 60
+IMPORT_FRESH_SEC = 24 * 3600
+# これより古いエントリは鮮度切れとしても返さず、取得を待つ (空室・料金は数時間で当てにならなくなる)
+VACANT_MAX_STALE_SEC = 3 * 3600
+AVAILABILITY_MAX_STALE_SEC = 3 * 3600
+IMPORT_MAX_STALE_SEC = 30 * 24 * 3600
+
+# 受付制御: エンドポイント種別ごとの (同時実行数, 待ち行列の上限, 待ち時間の上限秒)
+ADMISSION_LIMITS = {
+    "ai": (4, 32, 10.0),
+    "rakuten": (3, 30, 8.0),
+    "geo": (8, 64, 5.0),
+}
+
+# AI提案スポットの一括ジオコーディング (同時実行数と1件あたりのリトライ回数)
+GEOCODE_BATCH_CONCURRENCY = 4
+GEOCODE_BATCH_RETRIES = 2
+
+# イベントループの停止監視と管理者用プロファイラ (ADMIN_TOKEN 未設定なら管理エンドポイントは無効)
+LOOP_LAG_THRESHOLD_MS = float(os.getenv("LOOP_LAG_THRESHOLD_MS", "250"))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+PROFILE_MAX_SECONDS = 60
+
+# ルート沿い検索: サンプル点の目安・同時実行数・検索半径の上限・寄り道の所要時間換算 (車)
+# 半径が上限に達した長いルートでは隙間を埋めるため CORRIDOR_SAMPLE_BUDGET 点まで増やす (外部APIの呼び出し回数の上限を兼ねる)
+CORRIDOR_MAX_SAMPLES = 12
+CORRIDOR_SAMPLE_BUDGET = 40
+CORRIDOR_CONCURRENCY = 4
+CORRIDOR_MAX_SEARCH_RADIUS_M = 3000
+CORRIDOR_SPEED_KMH = 30
+
+# /api/batch: 1リクエストにまとめられるサブリクエスト数と同時実行数
+BATCH_MAX_REQUESTS = 30
+BATCH_CONCURRENCY = 6
+
+# 空室検索結果のサーバー側ページング
+HOTEL_PAGE_MAX_SIZE = 50
+HOTEL_RESULT_SETS_MAX = 32 # ソート済みの結果セットをメモリに保持する件数
+
+# 画像プロキシ: 外部の画像を縮小してディスクにキャッシュし、APIレスポンスの画像URLをプロキシ経由に書き換える
+# IMAGE_PROXY_BASE_URL (例: https://api.example.com) が未設定なら書き換えは行わない
+IMAGE_PROXY_BASE_URL = os.getenv("IMAGE_PROXY_BASE_URL", "").rstrip("/")
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+IMAGE_PROXY_WIDTHS = (240, 480, 960)
+IMAGE_PROXY_DEFAULT_WIDTH = 480
+IMAGE_PROXY_MAX_SOURCE_BYTES = 10 * 1024 * 1024
+IMAGE_REWRITE_CACHE_MAX_BYTES = 16 * 1024 * 1024 # 画像URLを書き換え済みのレスポンスを保持する上限
+IMAGE_PROXY_HOSTS = tuple(h.strip() for h in os.getenv(
+    "IMAGE_PROXY_HOSTS", "travel.rakuten.co.jp,r10s.jp,hotp.jp,wikimedia.org,wikipedia.org"
+).split(",") if h.strip())
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None # Pillowがなければ縮小せず原寸のままキャッシュする
+# キャッシュ名・ETagに含める縮小方式。Pillowを後から入れたり設定を変えたら、原寸のまま配った画像を差し替えられるようにする
+IMAGE_RESIZER = "pil-jpeg-q80" if Image is not None else "original"
 
 # HTTPクライアント
 http_client = None
@@ -42,6 +166,7 @@ DB_PATH = "cache.db"
 def init_db():
     """キャッシュ用データベースの初期化"""
     with sqlite3.connect(DB_PATH) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
         conn.execute("""
             CREATE TABLE IF NOT EXISTS api_cache (
                 key TEXT PRIMARY KEY,
@@ -49,44 +174,402 @@ def init_db():
                 created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         """)
+        # 楽天から取得したホテル基本情報のローカル在庫 (座標はR-treeで索引)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS hotel_inventory (
+                hotel_no INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                latitude REAL NOT NULL,
+                longitude REAL NOT NULL,
+                address TEXT,
+                rating REAL,
+                review_count INTEGER,
+                min_charge INTEGER,
+                last_price INTEGER,
+                image_url TEXT,
+                room_image_url TEXT,
+                url TEXT,
+                special TEXT,
+                detailed_ratings TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_hotel_rating ON hotel_inventory (rating)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_hotel_min_charge ON hotel_inventory (min_charge)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_hotel_last_price ON hotel_inventory (last_price)")
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS hotel_rtree USING rtree (
+                id, min_lat, max_lat, min_lng, max_lng
+            )
+        """)
+        # Geoapify Places から得たPOI (座標はR-treeで索引) と取得済み範囲
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS poi_store (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                place_id TEXT NOT NULL UNIQUE,
+                name TEXT NOT NULL,
+                latitude REAL NOT NULL,
+                longitude REAL NOT NULL,
+                address TEXT,
+                categories TEXT,
+                search_query TEXT,
+                image_url TEXT,
+                comment TEXT,
+                enriched INTEGER DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS poi_rtree USING rtree (
+                id, min_lat, max_lat, min_lng, max_lng
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS poi_coverage (
+                mode TEXT NOT NULL,
+                cell TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                PRIMARY KEY (mode, cell)
+            )
+        """)
+        # タイプアヘッド用の地名索引 (起動時にメモリへ読み込む)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS place_index (
+                id TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                place_name TEXT,
+                lng REAL NOT NULL,
+                lat REAL NOT NULL,
+                type TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
         conn.commit()
 
-def get_cache(key: str) -> Optional[Dict]:
+# キャッシュ値のバイナリ形式: [フォーマット版][圧縮フラグ] + orjsonバイト列 (大きいものはzlib圧縮)
+# 旧形式 (TEXT列のjson.dumps文字列) もそのまま読めるようにしておく
+CACHE_FORMAT_VERSION = 1
+CACHE_COMPRESS_MIN_BYTES = 1024
+_CACHE_RAW = 0
+_CACHE_ZLIB = 1
+
+def _json_default(obj):
+    if isinstance(obj, BaseModel): return obj.model_dump()
+    if isinstance(obj, (set, tuple)): return list(obj)
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+
+def dumps_json(data: Any) -> bytes:
+    return orjson.dumps(data, default=_json_default)
+
+def encode_cache_value(body: bytes) -> bytes:
+    if len(body) >= CACHE_COMPRESS_MIN_BYTES:
+        return bytes([CACHE_FORMAT_VERSION, _CACHE_ZLIB]) + zlib.compress(body, 6)
+    return bytes([CACHE_FORMAT_VERSION, _CACHE_RAW]) + body
+
+def decode_cache_value(value: Union[bytes, str, None]) -> Optional[bytes]:
+    """DBの格納値をJSONバイト列に戻す (未知の版はNone = キャッシュミス扱い)"""
+    if value is None: return None
+    if isinstance(value, str): return value.encode("utf-8")
+    if len(value) < 2 or value[0] != CACHE_FORMAT_VERSION: return None
+    if value[1] == _CACHE_ZLIB: return zlib.decompress(value[2:])
+    return bytes(value[2:])
+
+class HotCache:
+    """api_cache の手前に置くメモリ上のLRU (値はデコード済みJSONバイト列と作成時刻)"""
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self._touched: Optional[set] = None # preload中に書き込み・削除されたキー
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        item = self._items.get(key)
+        if item is not None: self._items.move_to_end(key)
+        return item
+
+    def put(self, key: str, body: bytes, created_at: float):
+        if self._touched is not None: self._touched.add(key)
+        if len(body) > self.max_bytes // 8: return
+        old = self._items.pop(key, None)
+        if old: self.size -= len(old[0])
+        self._items[key] = (body, created_at)
+        self.size += len(body)
+        while self.size > self.max_bytes and self._items:
+            _, (evicted, _) = self._items.popitem(last=False)
+            self.size -= len(evicted)
+
+    def pop(self, key: str):
+        if self._touched is not None: self._touched.add(key)
+        old = self._items.pop(key, None)
+        if old: self.size -= len(old[0])
+
+    async def preload(self, limit: int) -> int:
+        """最近書き込まれたエントリをSQLiteから読み込む (起動時のウォームアップ用)。
+        LRUはループのスレッドからしか触らないので、別スレッドではSQLiteの読み出しとデコードだけを行う"""
+        self._touched = set()
+        try: rows = await asyncio.to_thread(read_recent_cache_rows, limit)
+        finally: touched, self._touched = self._touched, None
+        loaded = 0
+        for key, body, created_at in reversed(rows):
+            # 読み出した後に書き込み・削除されたキーは、古い値で上書きしたり復活させたりしない
+            if key in self._items or key in touched: continue
+            self.put(key, body, created_at)
+            loaded += 1
+        return loaded
+
+def read_recent_cache_rows(limit: int) -> List[Tuple[str, bytes, float]]:
+    """新しい順に (キー, JSONバイト列, 作成時刻) を返す"""
+    try:
+        with sqlite3.connect(DB_PATH) as conn:
+            rows = conn.execute(
+                "SELECT key, value, CAST(strftime('%s', created_at) AS REAL) FROM api_cache ORDER BY created_at DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+    except Exception as e:
+        print(f"Hot Cache Preload Error: {e}"); return []
+    decoded = []
+    for key, value, created_at in rows:
+        body = decode_cache_value(value)
+        if body: decoded.append((key, body, created_at or time.time()))
+    return decoded
+
+hot_cache = HotCache(HOT_CACHE_MAX_BYTES)
+
+def get_cache_entry(key: str) -> Optional[Tuple[bytes, float]]:
+    """(JSONバイト列, 作成時刻) を返す。ホットキャッシュになければSQLiteから読む"""
+    item = hot_cache.get(key)
+    if item: return item
     try:
         with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.execute("SELECT value FROM api_cache WHERE key = ?", (key,))
+            cursor = conn.execute("SELECT value, CAST(strftime('%s', created_at) AS REAL) FROM api_cache WHERE key = ?", (key,))
             row = cursor.fetchone()
             if row:
-                return json.loads(row[0])
+                body = decode_cache_value(row[0])
+                if body:
+                    hot_cache.put(key, body, row[1] or time.time())
+                    return body, row[1] or time.time()
     except Exception as e:
         print(f"Cache Read Error: {e}")
     return None
 
-def set_cache(key: str, data: Any):
+def get_cache_bytes(key: str) -> Optional[bytes]:
+    """デコードせずにJSONバイト列のまま取り出す (レスポンスへ直接流す用)"""
+    entry = get_cache_entry(key)
+    return entry[0] if entry else None
+
+def get_cache(key: str) -> Optional[Dict]:
+    body = get_cache_bytes(key)
+    if body:
+        try: return orjson.loads(body)
+        except Exception as e: print(f"Cache Decode Error: {e}")
+    return None
+
+def set_cache_bytes(key: str, body: bytes):
+    hot_cache.put(key, body, time.time())
     try:
         with sqlite3.connect(DB_PATH) as conn:
             conn.execute(
                 "INSERT OR REPLACE INTO api_cache (key, value) VALUES (?, ?)",
-                (key, json.dumps(data))
+                (key, sqlite3.Binary(encode_cache_value(body)))
             )
             conn.commit()
     except Exception as e:
         print(f"Cache Write Error: {e}")
 
+def delete_cache(key: str):
+    hot_cache.pop(key)
+    try:
+        with sqlite3.connect(DB_PATH) as conn:
+            conn.execute("DELETE FROM api_cache WHERE key = ?", (key,))
+            conn.commit()
+    except Exception as e:
+        print(f"Cache Delete Error: {e}")
+
+def set_cache(key: str, data: Any):
+    try:
+        body = dumps_json(data)
+    except Exception as e:
+        print(f"Cache Write Error: {e}"); return
+    set_cache_bytes(key, body)
+
+class FastJSONResponse(JSONResponse):
+    """orjsonでエンコードする既定のレスポンスクラス"""
+    def render(self, content: Any) -> bytes:
+        return rewrite_image_urls(dumps_json(content))
+
+def ndjson_line(data: Any) -> bytes:
+    return dumps_json(data) + b"\n"
+
+def make_etag(seed: str, body: bytes) -> str:
+    """キャッシュキーと内容から強いETagを作る"""
+    digest = hashlib.blake2b(seed.encode("utf-8") + b"\0" + body, digest_size=16).hexdigest()
+    return f'"{digest}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match: return False
+    base = etag.strip('"').split("-")[0]
+    for token in if_none_match.split(","):
+        token = token.strip()
+        if token == "*": return True
+        if token.startswith("W/"): token = token[2:]
+        # 圧縮表現のETag ("xxx-br" など) も同じ内容として扱う
+        if token.strip('"').split("-")[0] == base: return True
+    return False
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try: q = float(params.strip()[2:])
+            except ValueError: q = 0.0
+        if name: accepted[name.lower()] = q
+    if brotli is not None and accepted.get("br", 0) > 0: return "br"
+    if accepted.get("gzip", 0) > 0: return "gzip"
+    return None
+
+def json_bytes_response(body: bytes, request: Optional[Request] = None, etag_seed: Optional[str] = None,
+                        extra_headers: Optional[Dict[str, str]] = None) -> Response:
+    """エンコード済みのJSONをそのまま返す (ETag / If-None-Match / 圧縮に対応)"""
+    # キャッシュには元の画像URLを入れておき、プロキシ経由への書き換えは返す直前に行う
+    body = proxied_json_bytes(body, etag_seed)
+    headers = dict(extra_headers or {})
+    encoding = None
+    if request is not None and len(body) >= RESPONSE_COMPRESS_MIN_BYTES:
+        headers["Vary"] = "Accept-Encoding"
+        encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+    if request is not None and etag_seed is not None:
+        etag = make_etag(etag_seed, body)
+        # 圧縮表現ごとに別のETagにする (強いETagの要件)
+        if encoding: etag = etag[:-1] + ("-br" if encoding == "br" else "-gz") + '"'
+        headers["ETag"] = etag
+        headers["Cache-Control"] = "private, no-cache"
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+    if encoding == "br":
+        body = brotli.compress(body, quality=4)
+    elif encoding == "gzip":
+        body = gzip.compress(body, compresslevel=5)
+    if encoding: headers["Content-Encoding"] = encoding
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def cached_response(key: str, request: Optional[Request] = None) -> Optional[Response]:
+    """キャッシュヒット時はデコード→再エンコードせずにバイト列を返す"""
+    body = get_cache_bytes(key)
+    if body: return json_bytes_response(body, request, key)
+    return None
+
+def store_and_respond(key: str, data: Any, store: bool = True, request: Optional[Request] = None) -> Response:
+    """一度だけエンコードして、キャッシュ書き込みとレスポンスの両方に使う"""
+    body = dumps_json(data)
+    if store: set_cache_bytes(key, body)
+    return json_bytes_response(body, request, key if store else None)
+
+# --- stale-while-revalidate ---
+# 鮮度切れ (または force_refresh) のエントリは即座に返し、更新はバックグラウンドで1回だけ行う
+_revalidations: Dict[str, asyncio.Task] = {}
+
+def schedule_group_revalidation(keys: List[str], refresh) -> List[str]:
+    """複数のキーを refresh(keys) が返すコルーチン1回でまとめて更新する。更新が実行中のキーは除き、予約したキーを返す"""
+    keys = [k for k in dict.fromkeys(keys) if k not in _revalidations]
+    if not keys: return []
+    async def run():
+        try: await refresh(keys)
+        except Exception as e: print(f"Revalidation Error ({keys[0]}{f' +{len(keys) - 1}' if len(keys) > 1 else ''}): {e}")
+    task = asyncio.create_task(run())
+    for key in keys:
+        _revalidations[key] = task
+        task.add_done_callback(lambda _, key=key: _revalidations.pop(key, None))
+    return keys
+
+def schedule_revalidation(key: str, refresh) -> bool:
+    """refresh() が返すコルーチンでキーを更新する。同じキーの更新が実行中なら何もしない"""
+    return bool(schedule_group_revalidation([key], lambda _: refresh()))
+
+def get_cache_swr(key: str, fresh_sec: float, refresh, force_refresh: bool = False,
+                  max_stale_sec: Optional[float] = None) -> Optional[Tuple[bytes, bool]]:
+    """(JSONバイト列, 鮮度切れか) を返す。鮮度切れなら refresh でバックグラウンド更新を予約する
+    (refresh=None なら予約せず、呼び出し側でまとめて更新する)。max_stale_sec より古ければキャッシュなし扱い"""
+    entry = get_cache_entry(key)
+    if not entry: return None
+    body, created_at = entry
+    age = time.time() - created_at
+    if max_stale_sec is not None and age > max_stale_sec: return None
+    stale = force_refresh or age > fresh_sec
+    if stale and refresh is not None: schedule_revalidation(key, refresh)
+    return body, stale
+
+def mark_stale(body: bytes) -> bytes:
+    """JSONオブジェクトの先頭に "stale": true を差し込む (デコードせずに済ませる)"""
+    if body.startswith(b"{") and len(body) > 2: return b'{"stale":true,' + body[1:]
+    return body
+
+def swr_response(key: str, cached: Tuple[bytes, bool], request: Optional[Request] = None) -> Response:
+    body, stale = cached
+    if not stale: return json_bytes_response(body, request, key)
+    return json_bytes_response(mark_stale(body), request, key, extra_headers={"X-Cache": "STALE"})
+
 # ==========================================
 # 🚀 アプリケーションライフサイクル
 # ==========================================
+startup_state = {"ready": False, "timings_ms": {}}
+loop_monitor = LoopLagMonitor(LOOP_LAG_THRESHOLD_MS)
+loop_thread_id: Optional[int] = None
+profile_lock = asyncio.Lock()
+
+def _elapsed_ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 1)
+
+async def warm_up():
+    """起動直後にバックグラウンドで重い初期化を済ませる (完了すると /ready が200を返す)"""
+    global place_index
+    timings = startup_state["timings_ms"]
+    try:
+        t = time.perf_counter()
+        loaded = await hot_cache.preload(HOT_CACHE_PRELOAD_ROWS)
+        timings["hot_cache_preload"] = _elapsed_ms(t)
+        startup_state["hot_cache_entries"] = loaded
+
+        t = time.perf_counter()
+        # 読み込み中も古い索引で応答できるよう、別インスタンスに読み込んでから差し替える
+        new_index = PlaceIndex()
+        await asyncio.to_thread(new_index.load)
+        place_index = new_index
+        timings["place_index_load"] = _elapsed_ms(t)
+
+        t = time.perf_counter()
+        await asyncio.to_thread(load_numpy)
+        if OPENAI_API_KEY: await asyncio.to_thread(get_openai_client)
+        timings["deferred_imports"] = _elapsed_ms(t)
+    except Exception as e:
+        print(f"Warm-up Error: {e}")
+    startup_state["ready"] = True
+    timings["total_since_import"] = _elapsed_ms(_IMPORT_STARTED)
+    print(f"🔥 Warm-up finished: {timings}")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    startup_state["timings_ms"]["import_to_lifespan"] = _elapsed_ms(_IMPORT_STARTED)
+    t = time.perf_counter()
     init_db()
-    global http_client
+    startup_state["timings_ms"]["init_db"] = _elapsed_ms(t)
+    global http_client, loop_thread_id
     http_client = httpx.AsyncClient(verify=False, timeout=30.0)
+    loop_thread_id = threading.get_ident()
+    loop_monitor.start()
+    warm_up_task = asyncio.create_task(warm_up())
     print("✅ System initialized with Strict Address Logic (No Gun, City Priority)")
     yield
+    warm_up_task.cancel()
+    loop_monitor.stop()
     if http_client:
         await http_client.aclose()
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -94,13 +577,22 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Cache"],
 )
 
-aclient = AsyncOpenAI(
-    api_key=OPENAI_API_KEY,
-    max_retries=5,     
-    timeout=60.0       
-)
+aclient = None
+
+def get_openai_client():
+    """OpenAIクライアントは初回利用時 (またはウォームアップ時) に生成する (importが重いため)"""
+    global aclient
+    if aclient is None:
+        from openai import AsyncOpenAI
+        aclient = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            max_retries=5,     
+            timeout=60.0       
+        )
+    return aclient
 
 # --- 型定義 ---
 class ExistingSpot(BaseModel):
@@ -128,11 +620,51 @@ class VacantSearchRequest(BaseModel):
     min_reviews: Optional[int] = 50
     hotel_type: Optional[str] = "all"
     force_refresh: bool = False
+    max_pages: int = 5 # 楽天のページング上限 (1ページ30件)
+    # サーバー側ソート・ページング (page_size 未指定なら従来どおり全件を返す)
+    sort_by: Optional[str] = None # "price" | "rating" | "review_count" | "distance"
+    descending: Optional[bool] = None # 未指定なら price/distance は昇順、rating/review_count は降順
+    max_distance_km: Optional[float] = None
+    page_size: Optional[int] = None
+    cursor: Optional[str] = None
+
+class PriceCalendarRequest(BaseModel):
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    radius: float = 3.0
+    hotel_no: Optional[str] = None
+    start_date: str
+    end_date: Optional[str] = None # 省略時は start_date から nights 日分
+    nights: int = 14
+    stay_nights: int = 1
+    adult_num: int = 2
+    min_price: Optional[int] = None
+    max_price: Optional[int] = None
+    meal_type: Optional[str] = None
+    polygon: Optional[List[List[float]]] = None
+    min_rating: Optional[float] = 4.0
+    min_reviews: Optional[int] = 50
+    hotel_type: Optional[str] = "all"
+    max_pages: int = 2
+
+class BatchAvailabilityRequest(BaseModel):
+    hotel_nos: List[str]
+    checkin_date: Optional[str] = None
+    checkout_date: Optional[str] = None
+    adult_num: int = 2
+    meal_type: Optional[str] = None
+    min_price: Optional[int] = None
+    max_price: Optional[int] = None
+    force_refresh: bool = False
 
 class ImportRequest(BaseModel):
     url: str
     force_refresh: bool = False
 
+class BulkImportRequest(BaseModel):
+    urls: List[str] # 楽天トラベルのURL またはホテル番号
+    force_refresh: bool = False
+
 class SuggestRequest(BaseModel):
     theme: str             
     existing_spots: List[Union[ExistingSpot, str, Dict[str, Any]]] = [] 
@@ -197,6 +729,18 @@ class NearbyRequest(BaseModel):
     limit: int = 20
     mode: str = "standard" 
 
+class LocalHotelSearchRequest(BaseModel):
+    latitude: Optional[float] = None
+    longitude: Optional[float] = None
+    radius: float = 3.0 # km
+    bbox: Optional[List[float]] = None # [min_lng, min_lat, max_lng, max_lat]
+    polygon: Optional[List[List[float]]] = None
+    min_rating: Optional[float] = None
+    min_reviews: Optional[int] = None
+    max_price: Optional[int] = None
+    hotel_type: Optional[str] = "all"
+    limit: int = 150
+
 # ---------------------------------------------------------
 # ユーティリティ & 住所正規化ロジック (強化版)
 # ---------------------------------------------------------
@@ -205,34 +749,6 @@ WIKI_HEADERS = {
     "User-Agent": "RouteHackerBot/1.0 (contact@example.com)"
 }
 
-def haversine_distance(coord1, coord2):
-    R = 6371
-    if not coord1 or not coord2: return float('inf')
-    try:
-        lat1, lon1 = math.radians(coord1[1]), math.radians(coord1[0])
-        lat2, lon2 = math.radians(coord2[1]), math.radians(coord2[0])
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
-        a = math.sin(dlat / 2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2)**2
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-        return R * c
-    except:
-        return float('inf')
-
-def is_inside_polygon(lat, lng, poly_coords):
-    inside = False
-    j = len(poly_coords) - 1
-    for i in range(len(poly_coords)):
-        xi, yi = poly_coords[i][0], poly_coords[i][1]
-        xj, yj = poly_coords[j][0], poly_coords[j][1]
-        
-        intersect = ((yi > lat) != (yj > lat)) and \
-            (lng < (xj - xi) * (lat - yi) / (yj - yi) + xi)
-        if intersect:
-            inside = not inside
-        j = i
-    return inside
-
 PREF_NORMALIZER = {
     "北海道": "北海道", "Hokkaido": "北海道",
     "青森": "青森県", "Aomori": "青森県", "岩手": "岩手県", "Iwate": "岩手県",
@@ -354,14 +870,481 @@ def get_clean_address(props: dict) -> str:
     clean_formatted = formatted.replace("NN", "").replace(" ,", "").replace(", ", "").strip()
     return extract_and_fix_address(clean_formatted)
 
+# ---------------------------------------------------------
+# 🏨 ローカル宿泊施設インベントリ (SQLite + R-tree)
+# ---------------------------------------------------------
+def hotel_row_from_rakuten(basic: dict, user_review: Optional[dict] = None, price: Optional[int] = None) -> Optional[Dict]:
+    """楽天APIのhotelBasicInfo(+hotelRatingInfo)からインベントリ用の行を作る"""
+    try:
+        lat, lng = float(basic["latitude"]), float(basic["longitude"])
+        row = {
+            "hotel_no": int(basic["hotelNo"]), "name": basic["hotelName"],
+            "latitude": lat, "longitude": lng,
+            "address": re.sub(r'[一-龠ぁ-んァ-ン]{1,6}郡', '', f"{basic.get('address1', '')}{basic.get('address2', '')}"),
+            "rating": basic.get("reviewAverage"), "review_count": basic.get("reviewCount"),
+            "min_charge": basic.get("hotelMinCharge"), "last_price": price,
+            "image_url": basic.get("hotelImageUrl"), "room_image_url": basic.get("roomImageUrl"),
+            "url": basic.get("hotelInformationUrl"), "special": basic.get("hotelSpecial", ""),
+            "detailed_ratings": None,
+        }
+    except (KeyError, TypeError, ValueError):
+        return None
+    if user_review:
+        row["detailed_ratings"] = dumps_json({
+            "room": user_review.get("roomAverage", 0), "bath": user_review.get("bathAverage", 0),
+            "meal": user_review.get("mealAverage", 0), "service": user_review.get("serviceAverage", 0),
+            "location": user_review.get("locationAverage", 0), "equipment": user_review.get("equipmentAverage", 0)
+        }).decode("utf-8")
+    return row
+
+def upsert_hotels(rows: List[Dict]):
+    """ホテル基本情報をまとめてupsert (既存の詳細評価・価格は新しい値がある時だけ上書き)"""
+    rows = [r for r in rows if r]
+    if not rows: return
+    try:
+        with sqlite3.connect(DB_PATH) as conn:
+            conn.executemany("""
+                INSERT INTO hotel_inventory (
+                    hotel_no, name, latitude, longitude, address, rating, review_count, min_charge,
+                    last_price, image_url, room_image_url, url, special, detailed_ratings, updated_at
+                ) VALUES (
+                    :hotel_no, :name, :latitude, :longitude, :address, :rating, :review_count, :min_charge,
+                    :last_price, :image_url, :room_image_url, :url, :special, :detailed_ratings, CURRENT_TIMESTAMP
+                )
+                ON CONFLICT(hotel_no) DO UPDATE SET
+                    name = excluded.name, latitude = excluded.latitude, longitude = excluded.longitude,
+                    address = excluded.address, rating = excluded.rating, review_count = excluded.review_count,
+                    min_charge = COALESCE(excluded.min_charge, min_charge),
+                    last_price = COALESCE(excluded.last_price, last_price),
+                    image_url = COALESCE(excluded.image_url, image_url),
+                    room_image_url = COALESCE(excluded.room_image_url, room_image_url),
+                    url = COALESCE(excluded.url, url), special = excluded.special,
+                    detailed_ratings = COALESCE(excluded.detailed_ratings, detailed_ratings),
+                    updated_at = CURRENT_TIMESTAMP
+            """, rows)
+            conn.executemany(
+                "INSERT OR REPLACE INTO hotel_rtree (id, min_lat, max_lat, min_lng, max_lng) VALUES (?, ?, ?, ?, ?)",
+                [(r["hotel_no"], r["latitude"], r["latitude"], r["longitude"], r["longitude"]) for r in rows]
+            )
+            conn.commit()
+    except Exception as e:
+        print(f"Inventory Write Error: {e}")
+    place_index.add([
+        {"id": f"rakuten:{r['hotel_no']}", "name": r["name"], "place_name": r["address"], "center": [r["longitude"], r["latitude"]], "type": "hotel"}
+        for r in rows
+    ])
+
+def query_local_hotels(min_lng: float, min_lat: float, max_lng: float, max_lat: float,
+                       min_rating: Optional[float] = None, min_reviews: Optional[int] = None,
+                       max_price: Optional[int] = None, limit: int = 500) -> List[Dict]:
+    """矩形範囲内のホテルをR-tree経由で取得 (評価・価格はSQL側で絞り込み)"""
+    sql = """
+        SELECT h.* FROM hotel_rtree r JOIN hotel_inventory h ON h.hotel_no = r.id
+        WHERE r.min_lat >= ? AND r.max_lat <= ? AND r.min_lng >= ? AND r.max_lng <= ?
+    """
+    params: List[Any] = [min_lat, max_lat, min_lng, max_lng]
+    if min_rating: sql += " AND h.rating >= ?"; params.append(min_rating)
+    if min_reviews: sql += " AND h.review_count >= ?"; params.append(min_reviews)
+    if max_price: sql += " AND COALESCE(h.last_price, h.min_charge) <= ?"; params.append(max_price)
+    sql += " ORDER BY h.rating DESC LIMIT ?"
+    params.append(limit)
+    try:
+        with sqlite3.connect(DB_PATH) as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute(sql, params)]
+    except Exception as e:
+        print(f"Inventory Read Error: {e}")
+    return []
+
+def hotel_spot_from_row(row: Dict) -> Dict:
+    """インベントリの行を search_hotels_vacant と同じ形のスポットに変換"""
+    spot = {
+        "id": str(row["hotel_no"]), "name": row["name"], "description": row.get("address") or "",
+        "coordinates": [row["longitude"], row["latitude"]], "image_url": row.get("image_url"),
+        "url": row.get("url"), "price": row.get("last_price") or row.get("min_charge") or 0,
+        "rating": row.get("rating") or 0.0, "review_count": row.get("review_count") or 0,
+        "source": "rakuten", "is_hotel": True, "status": "hotel_candidate",
+        "comment": (row.get("special") or "")[:60] + "...", "is_local": True
+    }
+    if row.get("detailed_ratings"): spot["detailed_ratings"] = orjson.loads(row["detailed_ratings"])
+    return spot
+
+# ---------------------------------------------------------
+# 🔎 ローカル地名インデックス (タイプアヘッド用)
+# ---------------------------------------------------------
+def normalize_place_text(text: str) -> str:
+    return unicodedata.normalize("NFKC", text or "").lower().replace(" ", "")
+
+class PlaceIndex:
+    """Geoapify・楽天・ホットペッパーから得た地名の前方一致/部分一致索引 (SQLiteに永続化)"""
+    def __init__(self):
+        self._entries: Dict[str, Dict] = {}
+        self._keys: List[Tuple[str, str]] = [] # (正規化した名称/住所, id) のソート済みリスト
+        self._grams: Dict[str, set] = defaultdict(set) # 2文字n-gram -> id
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _index(self, entry: Dict):
+        place_id = entry["id"]
+        old = self._entries.get(place_id)
+        if old:
+            for text in {normalize_place_text(old["name"]), normalize_place_text(old["place_name"])}:
+                i = bisect.bisect_left(self._keys, (text, place_id))
+                if i < len(self._keys) and self._keys[i] == (text, place_id): self._keys.pop(i)
+        self._entries[place_id] = entry
+        for text in {normalize_place_text(entry["name"]), normalize_place_text(entry["place_name"])}:
+            if not text: continue
+            bisect.insort(self._keys, (text, place_id))
+            for i in range(len(text) - 1):
+                self._grams[text[i:i + 2]].add(place_id)
+
+    def add(self, places: List[Dict], persist: bool = True):
+        """search_places の結果と同じ形 (id, name, place_name, center, type) の地点を追加"""
+        rows = []
+        for p in places:
+            if not p.get("id") or not p.get("name") or not p.get("center"): continue
+            entry = {"id": str(p["id"]), "name": p["name"], "place_name": p.get("place_name") or "",
+                     "center": [float(p["center"][0]), float(p["center"][1])], "type": p.get("type", "place")}
+            self._index(entry)
+            rows.append((entry["id"], entry["name"], entry["place_name"], entry["center"][0], entry["center"][1], entry["type"]))
+        if persist and rows:
+            try:
+                with sqlite3.connect(DB_PATH) as conn:
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO place_index (id, name, place_name, lng, lat, type) VALUES (?, ?, ?, ?, ?, ?)", rows
+                    )
+                    conn.commit()
+            except Exception as e:
+                print(f"Place Index Write Error: {e}")
+
+    def load(self):
+        try:
+            with sqlite3.connect(DB_PATH) as conn:
+                rows = conn.execute("SELECT id, name, place_name, lng, lat, type FROM place_index").fetchall()
+        except Exception as e:
+            print(f"Place Index Load Error: {e}"); return
+        self.add([{"id": r[0], "name": r[1], "place_name": r[2], "center": [r[3], r[4]], "type": r[5]} for r in rows], persist=False)
+
+    def search(self, query: str, lat: Optional[float] = None, lng: Optional[float] = None, limit: int = 5) -> List[Dict]:
+        q = normalize_place_text(query)
+        if not q: return []
+        prefix_ids = []
+        i = bisect.bisect_left(self._keys, (q, ""))
+        while i < len(self._keys) and self._keys[i][0].startswith(q) and len(prefix_ids) < PLACE_INDEX_MAX_CANDIDATES:
+            prefix_ids.append(self._keys[i][1]); i += 1
+        candidates = dict.fromkeys(prefix_ids, 0)
+        if len(q) >= 2 and len(candidates) < PLACE_INDEX_MAX_CANDIDATES:
+            grams = [self._grams.get(q[j:j + 2], set()) for j in range(len(q) - 1)]
+            for place_id in set.intersection(*sorted(grams, key=len)) if all(grams) else set():
+                if place_id in candidates: continue
+                e = self._entries[place_id]
+                # n-gramは候補の絞り込みだけなので、実際に部分一致するものだけ残す
+                if q in normalize_place_text(e["name"]) or q in normalize_place_text(e["place_name"]):
+                    candidates[place_id] = 1
+                if len(candidates) >= PLACE_INDEX_MAX_CANDIDATES: break
+
+        def rank(place_id):
+            e = self._entries[place_id]
+            dist = haversine_distance([lng, lat], e["center"]) if lat is not None and lng is not None else 0.0
+            return (candidates[place_id], dist)
+        return [dict(self._entries[pid]) for pid in sorted(candidates, key=rank)[:limit]]
+
+place_index = PlaceIndex()
+
+# ---------------------------------------------------------
+# 📍 ローカルPOIストア (Geoapify Places の蓄積 + 取得済み範囲の記録)
+# ---------------------------------------------------------
+NEARBY_CATEGORIES = {
+    "wide": "commercial.shopping_mall,catering.restaurant,entertainment,leisure.park",
+    "standard": "tourism,building.historic,natural,entertainment.culture,religion",
+}
+
+def nearby_categories(mode: str) -> str:
+    return NEARBY_CATEGORIES["wide"] if mode == "wide" else NEARBY_CATEGORIES["standard"]
+
+def poi_matches_mode(categories: List[str], mode: str) -> bool:
+    wanted = nearby_categories(mode).split(",")
+    return any(c == w or c.startswith(w + ".") for c in categories for w in wanted)
+
+def poi_cells_in_radius(lat: float, lng: float, radius_m: float) -> List[str]:
+    """円に掛かるグリッドセル"""
+    radius_km = radius_m / 1000.0
+    d_lat = radius_km / 111.0
+    d_lng = radius_km / (111.0 * max(math.cos(math.radians(lat)), 0.01))
+    g = POI_GRID_DEG
+    cells = []
+    for i in range(math.floor((lat - d_lat) / g), math.floor((lat + d_lat) / g) + 1):
+        for j in range(math.floor((lng - d_lng) / g), math.floor((lng + d_lng) / g) + 1):
+            # セル内で中心に最も近い点が円内なら、円はそのセルに掛かっている
+            nearest = [min(max(lng, j * g), (j + 1) * g), min(max(lat, i * g), (i + 1) * g)]
+            if haversine_distance([lng, lat], nearest) <= radius_km: cells.append(f"{i}:{j}")
+    return cells or [f"{math.floor(lat / g)}:{math.floor(lng / g)}"]
+
+def poi_missing_cells(mode: str, cells: List[str]) -> List[str]:
+    """未取得または期限切れのセル"""
+    cells = list(dict.fromkeys(cells))
+    try:
+        with sqlite3.connect(DB_PATH) as conn:
+            placeholders = ",".join("?" * len(cells))
+            fresh = {row[0] for row in conn.execute(
+                f"SELECT cell FROM poi_coverage WHERE mode = ? AND fetched_at >= ? AND cell IN ({placeholders})",
+                [mode, time.time() - POI_COVERAGE_TTL_SEC, *cells]
+            )}
+            return [c for c in cells if c not in fresh]
+    except Exception as e:
+        print(f"POI Coverage Read Error: {e}")
+    return cells
+
+def poi_coverage_missing(mode: str, cells: List[str]) -> bool:
+    """いずれかのセルが未取得または期限切れならTrue"""
+    return bool(poi_missing_cells(mode, cells))
+
+def mark_poi_coverage(mode: str, cells: List[str]):
+    try:
+        with sqlite3.connect(DB_PATH) as conn:
+            now = time.time()
+            conn.executemany("INSERT OR REPLACE INTO poi_coverage (mode, cell, fetched_at) VALUES (?, ?, ?)", [(mode, c, now) for c in cells])
+            conn.commit()
+    except Exception as e:
+        print(f"POI Coverage Write Error: {e}")
+
+def upsert_pois(rows: List[Dict]):
+    if not rows: return
+    try:
+        with sqlite3.connect(DB_PATH) as conn:
+            for r in rows:
+                cur = conn.execute("""
+                    INSERT INTO poi_store (place_id, name, latitude, longitude, address, categories, search_query, updated_at)
+                    VALUES (:place_id, :name, :latitude, :longitude, :address, :categories, :search_query, CURRENT_TIMESTAMP)
+                    ON CONFLICT(place_id) DO UPDATE SET
+                        name = excluded.name, latitude = excluded.latitude, longitude = excluded.longitude,
+                        address = excluded.address, categories = excluded.categories,
+                        search_query = excluded.search_query, updated_at = CURRENT_TIMESTAMP
+                    RETURNING id
+                """, r)
+                poi_id = cur.fetchone()[0]
+                conn.execute(
+                    "INSERT OR REPLACE INTO poi_rtree (id, min_lat, max_lat, min_lng, max_lng) VALUES (?, ?, ?, ?, ?)",
+                    (poi_id, r["latitude"], r["latitude"], r["longitude"], r["longitude"])
+                )
+            conn.commit()
+    except Exception as e:
+        print(f"POI Write Error: {e}")
+
+def update_poi_enrichment(place_id: str, image_url: Optional[str], comment: Optional[str]):
+    try:
+        with sqlite3.connect(DB_PATH) as conn:
+            conn.execute(
+                "UPDATE poi_store SET image_url = ?, comment = ?, enriched = 1 WHERE place_id = ?",
+                (image_url, comment or "", place_id)
+            )
+            conn.commit()
+    except Exception as e:
+        print(f"POI Write Error: {e}")
+
+def query_pois(lat: float, lng: float, radius_m: float, mode: Optional[str] = None, limit: int = 20) -> List[Dict]:
+    """半径内のPOIを距離順に返す (modeを指定するとカテゴリで絞り込み)"""
+    radius_km = radius_m / 1000.0
+    d_lat = radius_km / 111.0
+    d_lng = radius_km / (111.0 * max(math.cos(math.radians(lat)), 0.01))
+    try:
+        with sqlite3.connect(DB_PATH) as conn:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute("""
+                SELECT p.* FROM poi_rtree r JOIN poi_store p ON p.id = r.id
+                WHERE r.min_lat >= ? AND r.max_lat <= ? AND r.min_lng >= ? AND r.max_lng <= ?
+            """, (lat - d_lat, lat + d_lat, lng - d_lng, lng + d_lng)).fetchall()
+    except Exception as e:
+        print(f"POI Read Error: {e}"); return []
+    if not rows: return []
+    distances = haversine_to_point([[r["longitude"], r["latitude"]] for r in rows], [lng, lat])
+    found = []
+    for row, dist in zip(rows, distances.tolist()):
+        if dist > radius_km: continue
+        p = dict(row)
+        p["categories"] = (p.get("categories") or "").split(",")
+        if mode and not poi_matches_mode(p["categories"], mode): continue
+        p["distance"] = dist
+        found.append(p)
+    found.sort(key=lambda p: p["distance"])
+    return found[:limit]
+
+def poi_to_spot(p: Dict) -> Dict:
+    return {
+        "id": f"nearby-{p['place_id']}", "name": p["name"], "description": p.get("address") or "",
+        "coordinates": [p["longitude"], p["latitude"]], "is_nearby": True, "search_query": p.get("search_query") or p["name"],
+        "image_url": p.get("image_url"), "comment": p.get("comment") or ""
+    }
+
+def poi_rows_from_features(features: List[Dict]) -> List[Dict]:
+    rows = []
+    for feat in features:
+        props = feat["properties"]
+        name = props.get("name", "")
+        coords = feat.get("geometry", {}).get("coordinates")
+        if not name or not coords or not props.get("place_id"): continue
+        rows.append({
+            "place_id": props["place_id"], "name": name, "latitude": coords[1], "longitude": coords[0],
+            "address": get_clean_address(props), "categories": ",".join(props.get("categories", [])),
+            "search_query": f"{name} {props.get('state', '')}".strip()
+        })
+    return rows
+
+async def fetch_poi_cell(client, cell: str, mode: str) -> bool:
+    """1セル分のPOIをページを送りながら取得して保存する。最後のページ (上限未満) まで読めたらTrue"""
+    i, j = map(int, cell.split(":"))
+    g = POI_GRID_DEG
+    rect = f"rect:{round(j * g, 6)},{round(i * g, 6)},{round((j + 1) * g, 6)},{round((i + 1) * g, 6)}"
+    for page in range(POI_FETCH_MAX_PAGES):
+        params = {
+            "categories": nearby_categories(mode), "filter": rect, "limit": POI_FETCH_LIMIT,
+            "offset": page * POI_FETCH_LIMIT, "apiKey": GEOAPIFY_API_KEY, "lang": "ja"
+        }
+        res = await fetch_with_retry(client, "https://api.geoapify.com/v2/places", params=params, initial_timeout=10.0)
+        if not res or res.status_code != 200: return False
+        features = res.json().get("features", [])
+        rows = poi_rows_from_features(features)
+        upsert_pois(rows)
+        place_index.add([{"id": r["place_id"], "name": r["name"], "place_name": r["address"], "center": [r["longitude"], r["latitude"]], "type": "place"} for r in rows])
+        if len(features) < POI_FETCH_LIMIT: return True
+    # ページ上限まで読んでもまだ続きがある密集セルは、取得済みにせず次回も取りに行く
+    return False
+
+async def fetch_poi_area(client, lat: float, lng: float, radius_m: float, mode: str):
+    """円に掛かるセルのうち未取得のものをGeoapifyから取得して保存し、全件読めたセルを取得済みにする"""
+    cells = poi_missing_cells(mode, poi_cells_in_radius(lat, lng, radius_m))
+    sem = asyncio.Semaphore(POI_FETCH_CONCURRENCY)
+    async def one(cell):
+        async with sem: return await fetch_poi_cell(client, cell, mode)
+    done = await asyncio.gather(*[one(c) for c in cells], return_exceptions=True)
+    covered = [c for c, ok in zip(cells, done) if ok is True]
+    for ok in done:
+        if isinstance(ok, Exception): print(f"POI Fetch Error: {ok}")
+    if covered: mark_poi_coverage(mode, covered)
+
 # ---------------------------------------------------------
 # 外部API連携関数 
 # ---------------------------------------------------------
-async def fetch_with_retry(client, url, params=None, headers=None, retries=5, initial_timeout=10.0):
+class RateLimiter:
+    """トークンバケット方式のレートリミッタ (プロセス内の全リクエストで共有)"""
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+rakuten_limiter = RateLimiter(RAKUTEN_RATE_PER_SEC, burst=RAKUTEN_RATE_BURST)
+
+class AdmissionGate:
+    """エンドポイント種別ごとの受付制御。同時実行数を超えた分は待ち行列に入れ、クライアントごとに
+    ラウンドロビンで順番を回す (1台の連打で他の利用者が締め出されない)。期限内に始められなければ断る"""
+    def __init__(self, name: str, max_active: int, max_queue: int, deadline_sec: float):
+        self.name = name
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.deadline_sec = deadline_sec
+        self.active = 0
+        self.rejected = 0
+        self._waiting = 0
+        self._waiters: "OrderedDict[str, deque]" = OrderedDict() # クライアント -> 待機中のFuture
+        self._avg_service_sec = 1.0
+
+    def _discard(self, client_id: str, fut: asyncio.Future):
+        queue = self._waiters.get(client_id)
+        if queue is None or fut not in queue: return
+        queue.remove(fut)
+        self._waiting -= 1
+        if not queue: del self._waiters[client_id]
+
+    def _grant_next(self) -> bool:
+        """次のクライアントの先頭に枠を譲る (譲れたらTrue)"""
+        while self._waiters:
+            client_id, queue = next(iter(self._waiters.items()))
+            fut = queue.popleft()
+            self._waiting -= 1
+            if queue: self._waiters.move_to_end(client_id)
+            else: del self._waiters[client_id]
+            if not fut.done():
+                fut.set_result(True)
+                return True
+        return False
+
+    async def acquire(self, client_id: str) -> bool:
+        if self.active < self.max_active and not self._waiting:
+            self.active += 1
+            return True
+        if self._waiting >= self.max_queue:
+            self.rejected += 1
+            return False
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(client_id, deque()).append(fut)
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), self.deadline_sec)
+            return True
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            # 期限切れ (または切断) と同時に順番が回ってきていたら、その枠を次の人へ回す
+            if fut.done(): self.release()
+            else:
+                fut.cancel()
+                self._discard(client_id, fut)
+            if isinstance(e, asyncio.CancelledError): raise
+            self.rejected += 1
+            return False
+
+    def release(self, service_sec: Optional[float] = None):
+        if service_sec is not None: self._avg_service_sec = 0.8 * self._avg_service_sec + 0.2 * service_sec
+        if not self._grant_next(): self.active -= 1
+
+    def retry_after(self) -> int:
+        """今の待ち行列が捌けるまでの目安 (秒)"""
+        return max(1, math.ceil((self._waiting + 1) / self.max_active * self._avg_service_sec))
+
+class AdmissionTicket:
+    """受付済みの1リクエスト分の枠。release() は何度呼んでも1回だけ効く"""
+    def __init__(self, gate: AdmissionGate):
+        self.gate = gate
+        self.started = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self._released: return
+        self._released = True
+        self.gate.release(time.monotonic() - self.started)
+
+admission_gates = {name: AdmissionGate(name, *limits) for name, limits in ADMISSION_LIMITS.items()}
+
+def admission_client_id(request: Optional[Request]) -> str:
+    if request is None: return "anonymous"
+    return request.headers.get("x-client-id") or (request.client.host if request.client else "anonymous")
+
+async def admit(gate_name: str, request: Optional[Request]) -> Union[AdmissionTicket, Response]:
+    """枠が取れればチケット、取れなければ Retry-After 付きの503を返す (キャッシュヒット時は呼ばないこと)"""
+    gate = admission_gates[gate_name]
+    if await gate.acquire(admission_client_id(request)): return AdmissionTicket(gate)
+    print(f"⚠️ Admission rejected ({gate_name}): active={gate.active} rejected={gate.rejected}")
+    return JSONResponse({"error": "混雑しています。しばらくしてから再度お試しください。"}, status_code=503,
+                        headers={"Retry-After": str(gate.retry_after())})
+
+async def fetch_with_retry(client, url, params=None, headers=None, retries=5, initial_timeout=10.0, limiter: Optional[RateLimiter] = None):
     current_timeout = initial_timeout
     wait_time = 1.0
     for attempt in range(retries + 1):
         try:
+            if limiter: await limiter.acquire()
             res = await client.get(url, params=params, headers=headers, timeout=current_timeout)
             if res.status_code != 429 and res.status_code < 500:
                 return res
@@ -443,53 +1426,95 @@ async def fetch_wikipedia_info(client, query: str, target_name: str = None):
         print(f"Wiki info fetch error: {e}")
     return {"image_url": None, "summary": None}
 
+GEOAPIFY_SEARCH_URL = "https://api.geoapify.com/v1/geocode/search"
+
+def clean_search_query(search_query: str) -> str:
+    return re.sub(r'[(（].*?[)）]', '', search_query).strip()
+
+async def geocode_search_feature(client, search_query: str, retries: int = 5) -> Optional[Dict]:
+    """Geoapifyの正ジオコーディングで、名前のある最初の候補を返す"""
+    params = {"text": clean_search_query(search_query), "apiKey": GEOAPIFY_API_KEY, "lang": "ja", "limit": 3, "countrycode": "jp"}
+    res = await fetch_with_retry(client, GEOAPIFY_SEARCH_URL, params=params, initial_timeout=8.0, retries=retries)
+    if not res or res.status_code != 200: return None
+    for feat in res.json().get("features", []):
+        result_name = feat["properties"].get("name", "")
+        if result_name and result_name.strip(): return feat
+    return None
+
+async def spot_from_search_feature(client, feat: Dict, search_query: str) -> Dict:
+    """ジオコーディング結果1件をWikipediaの画像・概要で補ってスポットにする"""
+    props = feat["properties"]
+    result_name = props.get("name", "")
+    desc = get_clean_address(props)
+    if not desc: desc = "住所不明"
+
+    state = props.get("state", "")
+    wiki_query = f"{result_name} {state}".strip()
+    if len(wiki_query) < len(result_name) + 2: wiki_query = search_query
+
+    image_url = None
+    wiki_summary = None
+    try:
+        wiki_info = await fetch_wikipedia_info(client, wiki_query, target_name=result_name)
+        image_url = wiki_info.get("image_url")
+        if wiki_info.get("summary"): wiki_summary = wiki_info["summary"]
+    except: pass
+
+    return {
+        "name": result_name, "description": desc, 
+        "coordinates": feat["geometry"]["coordinates"],
+        "image_url": image_url, "comment": wiki_summary or "" 
+    }
+
 async def fetch_spot_coordinates(client, target_name: str, search_query: str):
     cache_key = f"geo_v5:{target_name}:{search_query}"
     cached = get_cache(cache_key)
     if cached: return cached
 
     try:
-        clean_query = re.sub(r'[(（].*?[)）]', '', search_query).strip()
-        url = "https://api.geoapify.com/v1/geocode/search"
-        params = {"text": clean_query, "apiKey": GEOAPIFY_API_KEY, "lang": "ja", "limit": 3, "countrycode": "jp"}
-        res = await fetch_with_retry(client, url, params=params, initial_timeout=8.0, retries=5)
-
-        image_url = None
-        wiki_summary = None
-        
-        if res and res.status_code == 200:
-            data = res.json()
-            if "features" in data and len(data["features"]) > 0:
-                for i, feat in enumerate(data["features"]):
-                    props = feat["properties"]
-                    result_name = props.get("name", "")
-                    if not result_name or not result_name.strip(): continue
-
-                    desc = get_clean_address(props)
-                    if not desc: desc = "住所不明"
-
-                    state = props.get("state", "")
-                    city = props.get("city", "") or props.get("town", "")
-                    wiki_query = f"{result_name} {state}".strip()
-                    if len(wiki_query) < len(result_name) + 2: wiki_query = search_query
-
-                    try:
-                        wiki_info = await fetch_wikipedia_info(client, wiki_query, target_name=result_name)
-                        image_url = wiki_info.get("image_url")
-                        if wiki_info.get("summary"): wiki_summary = wiki_info["summary"]
-                    except: pass
-
-                    result_data = {
-                        "name": result_name, "description": desc, 
-                        "coordinates": feat["geometry"]["coordinates"],
-                        "image_url": image_url, "comment": wiki_summary or "" 
-                    }
-                    set_cache(cache_key, result_data)
-                    return result_data
+        feat = await geocode_search_feature(client, search_query)
+        if feat:
+            result_data = await spot_from_search_feature(client, feat, search_query)
+            set_cache(cache_key, result_data)
+            return result_data
     except Exception as e:
         print(f"Coord fetch failed for {target_name}: {e}")
     return None
 
+async def geocode_spots_batch(client, spots: List[Dict], spawn=asyncio.create_task):
+    """候補リストをまとめてジオコーディングし、(候補, 結果) を解決した順に返す。
+    geo_v5 キャッシュを先に引き、残りは検索語ごとに1回だけ、同時実行数を絞って問い合わせる。
+    ジオコーディングが済んだものから順にWikipediaの補完へ進む (検索と補完をパイプラインで重ねる)"""
+    groups: Dict[str, List[Dict]] = {}
+    for s in spots:
+        cached = get_cache(f"geo_v5:{s['name']}:{s['search_query']}")
+        if cached:
+            yield s, cached
+            continue
+        groups.setdefault(clean_search_query(s["search_query"]), []).append(s)
+    if not groups: return
+
+    geo_sem = asyncio.Semaphore(GEOCODE_BATCH_CONCURRENCY)
+
+    async def resolve(members: List[Dict]):
+        async with geo_sem:
+            feat = await geocode_search_feature(client, members[0]["search_query"], retries=GEOCODE_BATCH_RETRIES)
+        result = await spot_from_search_feature(client, feat, members[0]["search_query"]) if feat else None
+        if result:
+            for s in members: set_cache(f"geo_v5:{s['name']}:{s['search_query']}", result)
+        return members, result
+
+    tasks = [spawn(resolve(members)) for members in groups.values()]
+    for future in asyncio.as_completed(tasks):
+        try:
+            members, result = await future
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Batch geocode failed: {e}")
+            continue
+        for s in members: yield s, (dict(result) if result else None)
+
 async def fetch_spot_by_coordinates(client, lat: float, lng: float, fallback_name: str):
     lat_k = round(lat, 6)
     lng_k = round(lng, 6)
@@ -552,7 +1577,7 @@ async def get_official_name_by_ai(query: str) -> str:
     例: そらてらす -> SORA terrace
     """
     try:
-        res = await aclient.chat.completions.create(
+        res = await get_openai_client().chat.completions.create(
             model="gpt-4o-mini", messages=[{"role": "user", "content": prompt}], max_tokens=50, temperature=0.0
         )
         normalized_name = res.choices[0].message.content.strip().replace('"', '').replace("「", "").replace("」", "")
@@ -573,7 +1598,7 @@ async def get_structured_address_by_ai(name: str, raw_address: str = "") -> Dict
     2. "city" は市・区・町・村まで。
     """
     try:
-        res = await aclient.chat.completions.create(
+        res = await get_openai_client().chat.completions.create(
             model="gpt-4o-mini", messages=[{"role": "user", "content": prompt}], response_format={"type": "json_object"}, temperature=0.0
         )
         data = json.loads(res.choices[0].message.content)
@@ -586,52 +1611,37 @@ async def get_structured_address_by_ai(name: str, raw_address: str = "") -> Dict
 # API: 各種エンドポイント
 # ---------------------------------------------------------
 @app.post("/api/nearby_spots")
-async def nearby_spots(req: NearbyRequest):
+async def nearby_spots(req: NearbyRequest, request: Request):
     global http_client
     if http_client is None: return {"spots": []}
     client = http_client
     lat_k = round(req.latitude, 3)
     lon_k = round(req.longitude, 3)
-    cache_key = f"nearby_v4:{lat_k}:{lon_k}:{req.radius}:{req.mode}"
-    cached = get_cache(cache_key)
-    if cached: return cached
+    cache_key = f"nearby_v5:{lat_k}:{lon_k}:{req.radius}:{req.mode}:{req.limit}"
+    # 取得済みにできない密集セルがあっても、同じ場所の連続した呼び出しではGeoapifyを呼ばない
+    hit = get_cache_entry(cache_key)
+    if hit and time.time() - hit[1] <= NEARBY_CACHE_TTL_SEC: return json_bytes_response(hit[0], request, cache_key)
     try:
-        url = "https://api.geoapify.com/v2/places"
-        if req.mode == "wide": categories = "commercial.shopping_mall,catering.restaurant,entertainment,leisure.park"
-        else: categories = "tourism,building.historic,natural,entertainment.culture,religion"
-        params = {
-            "categories": categories, "filter": f"circle:{req.longitude},{req.latitude},{req.radius}",
-            "bias": f"proximity:{req.longitude},{req.latitude}", "limit": 20, "apiKey": GEOAPIFY_API_KEY, "lang": "ja"
-        }
-        res = await fetch_with_retry(client, url, params=params, initial_timeout=10.0)
-        base_spots = []
-        if res and res.status_code == 200:
-            data = res.json()
-            if "features" in data:
-                for feat in data["features"]:
-                    props = feat["properties"]
-                    name = props.get("name", "")
-                    if not name: continue 
-                    coords = feat.get("geometry", {}).get("coordinates")
-                    if not coords: continue
-                    formatted = get_clean_address(props) 
-                    search_query = f"{name} {props.get('state', '')}".strip()
-                    base_spots.append({
-                        "id": f"nearby-{props.get('place_id')}", "name": name, "description": formatted, 
-                        "coordinates": coords, "is_nearby": True, "search_query": search_query, "image_url": None, "comment": "" 
-                    })
-        async def enrich(s):
+        # 取得済みの範囲ならローカルPOIストアだけで答え、未取得・期限切れの時だけGeoapifyを呼ぶ
+        if poi_coverage_missing(req.mode, poi_cells_in_radius(req.latitude, req.longitude, req.radius)):
+            await fetch_poi_area(client, req.latitude, req.longitude, req.radius, req.mode)
+        pois = query_pois(req.latitude, req.longitude, req.radius, req.mode, limit=req.limit)
+
+        async def enrich(p):
+            s = poi_to_spot(p)
+            if p.get("enriched"): return s
             try:
                 w = await fetch_wikipedia_info(client, s["search_query"], target_name=s["name"])
                 if w["image_url"]: s["image_url"] = w["image_url"]
                 if w["summary"]: s["comment"] = w["summary"]
+                update_poi_enrichment(p["place_id"], s["image_url"], s["comment"])
             except: pass
             return s
-        enriched_spots = await asyncio.gather(*[enrich(s) for s in base_spots]) if base_spots else []
-        result = {"spots": enriched_spots}
-        if enriched_spots: set_cache(cache_key, result)
-        return result
-    except: return {"spots": []}
+        enriched_spots = await asyncio.gather(*[enrich(p) for p in pois]) if pois else []
+        return store_and_respond(cache_key, {"spots": enriched_spots}, store=bool(enriched_spots), request=request)
+    except Exception as e:
+        print(f"Nearby Error: {e}")
+        return {"spots": []}
 
 @app.get("/api/get_spot_image")
 async def get_spot_image(query: str):
@@ -640,11 +1650,264 @@ async def get_spot_image(query: str):
     img_url = await fetch_wikipedia_image(http_client, query)
     return {"image_url": img_url}
 
+# ==========================================
+# 🖼️ 画像プロキシ (縮小 + ディスクキャッシュ)
+# ==========================================
+IMAGE_PROXY_PATH = "/api/image"
+
+def image_host_allowed(url: str) -> bool:
+    try: parsed = urllib.parse.urlsplit(url)
+    except ValueError: return False
+    host = (parsed.hostname or "").lower()
+    return parsed.scheme in ("http", "https") and any(host == h or host.endswith("." + h) for h in IMAGE_PROXY_HOSTS)
+
+def proxy_image_url(url: Optional[str], width: int = IMAGE_PROXY_DEFAULT_WIDTH) -> Optional[str]:
+    """外部画像のURLをプロキシ経由のURLに書き換える (設定がない・対象外のホスト・書き換え済みならそのまま)"""
+    if not url or not IMAGE_PROXY_BASE_URL or url.startswith(IMAGE_PROXY_BASE_URL) or not image_host_allowed(url): return url
+    return f"{IMAGE_PROXY_BASE_URL}{IMAGE_PROXY_PATH}?" + urllib.parse.urlencode({"url": url, "w": width})
+
+# JSON中の image_url / logo_image の文字列値 (エスケープを含む値も1つの文字列として取り出す)
+IMAGE_URL_FIELD_RE = re.compile(rb'"(image_url|logo_image)"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+def rewrite_image_urls(body: bytes) -> bytes:
+    """JSONバイト列の画像URLをプロキシ経由に書き換える。全体をデコードし直さず、該当する値だけ置き換える"""
+    if not IMAGE_PROXY_BASE_URL or (b'"image_url"' not in body and b'"logo_image"' not in body): return body
+    def sub(match):
+        url = orjson.loads(b'"' + match.group(2) + b'"')
+        proxied = proxy_image_url(url)
+        if proxied == url: return match.group(0)
+        return b'"' + match.group(1) + b'":' + orjson.dumps(proxied)
+    return IMAGE_URL_FIELD_RE.sub(sub, body)
+
+# 書き換え済みのレスポンス (キャッシュヒットのたびに画像URLを書き換え直さない)
+proxied_bodies = HotCache(IMAGE_REWRITE_CACHE_MAX_BYTES)
+
+def proxied_json_bytes(body: bytes, etag_seed: Optional[str] = None) -> bytes:
+    """rewrite_image_urls の結果を、キャッシュ可能なレスポンス (etag_seed あり) については内容ごとに使い回す"""
+    if not IMAGE_PROXY_BASE_URL or (b'"image_url"' not in body and b'"logo_image"' not in body): return body
+    if etag_seed is None: return rewrite_image_urls(body)
+    key = f"{etag_seed}:{hashlib.md5(body).hexdigest()}"
+    hit = proxied_bodies.get(key)
+    if hit: return hit[0]
+    rewritten = rewrite_image_urls(body)
+    proxied_bodies.put(key, rewritten, time.time())
+    return rewritten
+
+def snap_image_width(width: int) -> int:
+    """任意の幅を許可された幅に切り上げる (バリエーションを増やしすぎない)"""
+    return next((w for w in IMAGE_PROXY_WIDTHS if w >= width), IMAGE_PROXY_WIDTHS[-1])
+
+def resize_image(data: bytes, width: int) -> Tuple[bytes, str]:
+    """JPEGに縮小して返す。Pillowがない・デコードできない画像は原寸のまま返す"""
+    if Image is None: return data, ""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.thumbnail((width, width * 4))
+            if img.mode not in ("RGB", "L"): img = img.convert("RGB")
+            out = io.BytesIO()
+            img.save(out, format="JPEG", quality=80, optimize=True, progressive=True)
+            return out.getvalue(), "image/jpeg"
+    except Exception as e:
+        print(f"Image Resize Error: {e}")
+        return data, ""
+
+class ImageDiskCache:
+    """縮小済み画像のディスクキャッシュ。合計サイズが上限を超えたら最も使われていないファイルから消す。
+    ディスクI/Oはループを止めないよう asyncio.to_thread から呼ぶ前提で、索引の更新はロックで守る"""
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total = 0
+        self._files: "OrderedDict[str, int]" = OrderedDict() # ファイル名 -> サイズ (古い順)
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._loaded: return
+        self._loaded = True
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            try: st = os.stat(os.path.join(self.directory, name))
+            except OSError: continue
+            entries.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self.total += size
+
+    def get(self, name: str) -> Optional[bytes]:
+        with self._lock:
+            self._load()
+            if name not in self._files: return None
+        try:
+            with open(os.path.join(self.directory, name), "rb") as f: data = f.read()
+        except OSError:
+            with self._lock:
+                if name in self._files: self.total -= self._files.pop(name)
+            return None
+        with self._lock:
+            if name in self._files: self._files.move_to_end(name)
+        return data
+
+    def put(self, name: str, data: bytes):
+        with self._lock: self._load()
+        tmp = os.path.join(self.directory, f".{name}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp, "wb") as f: f.write(data)
+            os.replace(tmp, os.path.join(self.directory, name))
+        except OSError as e:
+            print(f"Image Cache Write Error: {e}")
+            return
+        evicted = []
+        with self._lock:
+            self.total += len(data) - self._files.pop(name, 0)
+            self._files[name] = len(data)
+            while self.total > self.max_bytes and len(self._files) > 1:
+                old, size = self._files.popitem(last=False)
+                self.total -= size
+                evicted.append(old)
+        for old in evicted:
+            try: os.remove(os.path.join(self.directory, old))
+            except OSError: pass
+
+image_cache = ImageDiskCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+_image_fetches: Dict[str, asyncio.Task] = {}
+
+def image_cache_name(url: str, width: int) -> Tuple[str, str]:
+    """(キャッシュファイル名, ETag用のハッシュ)"""
+    digest = hashlib.sha1(f"{url}\0{width}\0{IMAGE_RESIZER}".encode("utf-8")).hexdigest()
+    return f"{digest}.img", digest
+
+async def load_proxied_image(client, url: str, width: int) -> Optional[bytes]:
+    """キャッシュになければ取得・縮小して保存する。同じ画像の同時取得は1回にまとめる"""
+    name, _ = image_cache_name(url, width)
+    data = await asyncio.to_thread(image_cache.get, name)
+    if data is not None: return data
+    task = _image_fetches.get(name)
+    if task is None:
+        async def fetch():
+            res = await fetch_with_retry(client, url, initial_timeout=10.0, retries=2)
+            if not res or res.status_code != 200 or not res.headers.get("content-type", "").startswith("image/"): return None
+            if len(res.content) > IMAGE_PROXY_MAX_SOURCE_BYTES: return None
+            body, ctype = await asyncio.to_thread(resize_image, res.content, width)
+            # 1バイト目に Content-Type の長さ、続けて Content-Type を持たせて1ファイルに収める
+            ctype = (ctype or res.headers["content-type"].split(";")[0].strip()).encode()
+            blob = bytes([len(ctype)]) + ctype + body
+            await asyncio.to_thread(image_cache.put, name, blob)
+            return blob
+        task = asyncio.create_task(fetch())
+        _image_fetches[name] = task
+        task.add_done_callback(lambda _: _image_fetches.pop(name, None))
+    return await asyncio.shield(task)
+
+@app.get(IMAGE_PROXY_PATH)
+async def image_proxy(request: Request, url: str, w: int = IMAGE_PROXY_DEFAULT_WIDTH):
+    """許可されたホストの画像を縮小して返す (長期キャッシュ + ETag)"""
+    if not image_host_allowed(url): return JSONResponse({"error": "このホストの画像は扱えません。"}, status_code=400)
+    global http_client
+    if http_client is None: return JSONResponse({"error": "Server starting up..."}, status_code=503)
+    width = snap_image_width(w)
+    _, digest = image_cache_name(url, width)
+    etag = f'"{digest}"'
+    # 縮小できない環境で配る原寸画像は、縮小版に差し替えられるよう長期キャッシュさせない
+    cache_control = "public, max-age=2592000, immutable" if Image is not None else "public, max-age=86400"
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    # 内容はURLと幅で決まるので、ETagが一致すればディスクを読まずに304を返せる
+    if etag_matches(request.headers.get("if-none-match"), etag): return Response(status_code=304, headers=headers)
+    try:
+        blob = await load_proxied_image(http_client, url, width)
+    except Exception as e:
+        print(f"Image Proxy Error: {e}")
+        blob = None
+    if not blob: return JSONResponse({"error": "画像を取得できませんでした。"}, status_code=502)
+    ctype_len = blob[0]
+    return Response(content=blob[1 + ctype_len:], media_type=blob[1:1 + ctype_len].decode(), headers=headers)
+
+RAKUTEN_SIMPLE_URL = "https://app.rakuten.co.jp/services/api/Travel/SimpleHotelSearch/20170426"
+# SimpleHotelSearch の hotelNo に一度に指定できる件数の上限
+RAKUTEN_MULTI_HOTEL_LIMIT = 15
+
+async def resolve_rakuten_url(client, url: str) -> str:
+    """短縮URL等のリダイレクトを解決する"""
+    if "rakuten.co.jp" in url:
+        try:
+            res = await fetch_with_retry(client, url, initial_timeout=10.0)
+            if res: return str(res.url)
+        except: pass
+    return url
+
+def extract_rakuten_hotel_no(url: str) -> Optional[str]:
+    if url.isdigit(): return url
+    path_patterns = [r'hotelinfo/plan/(\d+)', r'HOTEL/(\d+)', r'hotel/(\d+)', r'travel\.rakuten\.co\.jp/.*?/(\d+)']
+    for pattern in path_patterns:
+        match = re.search(pattern, url, re.IGNORECASE)
+        if match: return match.group(1)
+    parsed = urllib.parse.urlparse(url)
+    qs = urllib.parse.parse_qs(parsed.query)
+    for key in ["f_no", "no", "hotelNo", "hotel_no"]:
+        if key in qs: return qs[key][0]
+    return None
+
+def spot_from_simple_hotel(raw_hotel: dict) -> Optional[Dict]:
+    """SimpleHotelSearchの1件をスポット形式に変換し、ローカル在庫にも反映する"""
+    hotel_content = raw_hotel["hotel"] if "hotel" in raw_hotel else raw_hotel
+    basic = None
+    user_review = {}
+    if isinstance(hotel_content, list):
+        for item in hotel_content:
+            if "hotelBasicInfo" in item: basic = item["hotelBasicInfo"]
+            if "hotelRatingInfo" in item: user_review = item["hotelRatingInfo"] 
+    else: basic = hotel_content.get("hotelBasicInfo")
+
+    if not basic: return None
+    upsert_hotels([hotel_row_from_rakuten(basic, user_review)])
+    address = f"{basic.get('address1', '')}{basic.get('address2', '')}"
+    address = re.sub(r'[一-龠ぁ-んァ-ン]{1,6}郡', '', address)
+
+    detailed_ratings = {
+        "room": user_review.get("roomAverage", 0),
+        "bath": user_review.get("bathAverage", 0),
+        "meal": user_review.get("mealAverage", 0),
+        "service": user_review.get("serviceAverage", 0),
+        "location": user_review.get("locationAverage", 0),
+        "equipment": user_review.get("equipmentAverage", 0)
+    }
+
+    return {
+        "id": str(basic["hotelNo"]), "name": basic["hotelName"], "description": address, 
+        "coordinates": [basic["longitude"], basic["latitude"]], "image_url": basic.get("hotelImageUrl"), 
+        "url": basic.get("hotelInformationUrl"), "price": basic.get("hotelMinCharge", 0), 
+        "rating": basic.get("reviewAverage", 3.0),
+        "detailed_ratings": detailed_ratings,
+        "source": "rakuten", "is_hotel": True, "status": "hotel_candidate",
+        "comment": (basic.get("hotelSpecial") or "")[:100] + "..." 
+    }
+
+async def fetch_simple_hotels(client, hotel_nos: List[str]) -> Dict[str, Optional[Dict]]:
+    """複数のホテル番号をまとめてSimpleHotelSearchで取得する (hotelNo -> スポット)"""
+    unique = list(dict.fromkeys(hotel_nos))
+    chunks = [unique[i:i + RAKUTEN_MULTI_HOTEL_LIMIT] for i in range(0, len(unique), RAKUTEN_MULTI_HOTEL_LIMIT)]
+
+    async def fetch_chunk(chunk):
+        params = {"applicationId": RAKUTEN_APP_ID, "format": "json", "hotelNo": ",".join(chunk), "datumType": 1}
+        res = await fetch_with_retry(client, RAKUTEN_SIMPLE_URL, params=params, initial_timeout=15.0, limiter=rakuten_limiter)
+        if not res or res.status_code != 200: return []
+        return res.json().get("hotels") or []
+
+    spots: Dict[str, Optional[Dict]] = {}
+    for raw_hotels in await asyncio.gather(*[fetch_chunk(c) for c in chunks]):
+        for raw_hotel in raw_hotels:
+            try:
+                spot = spot_from_simple_hotel(raw_hotel)
+                if spot: spots[spot["id"]] = spot
+            except Exception as e:
+                print(f"Import parse error: {e}")
+    return spots
+
 @app.post("/api/import_rakuten_hotel")
-async def import_rakuten_hotel(req: ImportRequest):
+async def import_rakuten_hotel(req: ImportRequest, request: Request):
     if not RAKUTEN_APP_ID: 
         return {"error": "サーバーの楽天APIキー設定が見つかりません。"}
-    hotel_no = None
     final_url = req.url.strip()
     global http_client
     if http_client is None: 
@@ -654,91 +1917,108 @@ async def import_rakuten_hotel(req: ImportRequest):
     try:
         cache_key = f"rakuten_import_v3:{final_url}"
         
-        # force_refreshフラグがFalseの時だけSQLiteキャッシュをチェック
-        if not req.force_refresh:
-            cached = get_cache(cache_key)
-            if cached: return cached
+        # force_refresh や鮮度切れの時もキャッシュを即座に返し、楽天への再取得は裏で行う
+        cached = get_cache_swr(cache_key, IMPORT_FRESH_SEC, lambda: refresh_import(client, final_url), req.force_refresh, IMPORT_MAX_STALE_SEC)
+        if cached: return swr_response(cache_key, cached, request)
 
-        if "rakuten.co.jp" in final_url:
-            try:
-                res = await fetch_with_retry(client, final_url, initial_timeout=10.0)
-                if res: final_url = str(res.url)
-            except: pass
-        
-        path_patterns = [r'hotelinfo/plan/(\d+)', r'HOTEL/(\d+)', r'hotel/(\d+)', r'travel\.rakuten\.co\.jp/.*?/(\d+)']
-        for pattern in path_patterns:
-            match = re.search(pattern, final_url, re.IGNORECASE)
-            if match:
-                hotel_no = match.group(1)
-                break
-        if not hotel_no:
-            parsed = urllib.parse.urlparse(final_url)
-            qs = urllib.parse.parse_qs(parsed.query)
-            for key in ["f_no", "no", "hotelNo", "hotel_no"]:
-                if key in qs:
-                    hotel_no = qs[key][0]; break
-        if not hotel_no: return {"error": "URLからホテルIDを特定できませんでした。"}
-
-        params = {"applicationId": RAKUTEN_APP_ID, "format": "json", "hotelNo": hotel_no, "datumType": 1}
-        api_url = "https://app.rakuten.co.jp/services/api/Travel/SimpleHotelSearch/20170426"
-        res = await fetch_with_retry(client, api_url, params=params, initial_timeout=15.0)
-        
-        if not res or res.status_code != 200: return {"error": f"楽天APIから情報を取得できませんでした。 (ID: {hotel_no})"}
-        data = res.json()
-        if "hotels" not in data or not data["hotels"]: return {"error": "該当するホテル情報が楽天APIに見つかりませんでした。"}
-
-        raw_hotel = data["hotels"][0]
-        hotel_content = raw_hotel["hotel"] if "hotel" in raw_hotel else raw_hotel
-        basic = None
-        user_review = {}
-        if isinstance(hotel_content, list):
-            for item in hotel_content:
-                if "hotelBasicInfo" in item: basic = item["hotelBasicInfo"]
-                if "hotelRatingInfo" in item: user_review = item["hotelRatingInfo"] 
-        else: basic = hotel_content.get("hotelBasicInfo")
-
-        if not basic: return {"error": "ホテル情報の解析に失敗しました。"}
-        address = f"{basic.get('address1', '')}{basic.get('address2', '')}"
-        address = re.sub(r'[一-龠ぁ-んァ-ン]{1,6}郡', '', address)
-
-        detailed_ratings = {
-            "room": user_review.get("roomAverage", 0),
-            "bath": user_review.get("bathAverage", 0),
-            "meal": user_review.get("mealAverage", 0),
-            "service": user_review.get("serviceAverage", 0),
-            "location": user_review.get("locationAverage", 0),
-            "equipment": user_review.get("equipmentAverage", 0)
-        }
-
-        spot_data = {
-            "id": str(basic["hotelNo"]), "name": basic["hotelName"], "description": address, 
-            "coordinates": [basic["longitude"], basic["latitude"]], "image_url": basic.get("hotelImageUrl"), 
-            "url": basic.get("hotelInformationUrl"), "price": basic.get("hotelMinCharge", 0), 
-            "rating": basic.get("reviewAverage", 3.0),
-            "detailed_ratings": detailed_ratings,
-            "source": "rakuten", "is_hotel": True, "status": "hotel_candidate",
-            "comment": basic.get("hotelSpecial", "")[:100] + "..." 
-        }
-        result = {"spot": spot_data}
-        set_cache(cache_key, result)
-        return result
+        result = await import_hotel_result(client, final_url)
+        if "spot" not in result: return result
+        return store_and_respond(cache_key, result, request=request)
     except Exception as e:
         print(f"Import Error: {e}")
         return {"error": f"取込処理中に予期せぬエラーが発生しました: {str(e)}"}
 
-@app.post("/api/search_hotels_vacant")
-async def search_hotels_vacant(req: VacantSearchRequest):
-    if not RAKUTEN_APP_ID: return {"error": "サーバー設定エラー"}
+async def import_hotel_result(client, url: str) -> Dict[str, Any]:
+    """URL (またはホテル番号) 1件を取り込み、{"spot": ...} か {"error": ...} を返す"""
+    final_url = await resolve_rakuten_url(client, url)
+    hotel_no = extract_rakuten_hotel_no(final_url)
+    if not hotel_no: return {"error": "URLからホテルIDを特定できませんでした。"}
+
+    params = {"applicationId": RAKUTEN_APP_ID, "format": "json", "hotelNo": hotel_no, "datumType": 1}
+    res = await fetch_with_retry(client, RAKUTEN_SIMPLE_URL, params=params, initial_timeout=15.0, limiter=rakuten_limiter)
+    
+    if not res or res.status_code != 200: return {"error": f"楽天APIから情報を取得できませんでした。 (ID: {hotel_no})"}
+    data = res.json()
+    if "hotels" not in data or not data["hotels"]: return {"error": "該当するホテル情報が楽天APIに見つかりませんでした。"}
+
+    spot_data = spot_from_simple_hotel(data["hotels"][0])
+    if not spot_data: return {"error": "ホテル情報の解析に失敗しました。"}
+    return {"spot": spot_data}
+
+async def refresh_import(client, url: str):
+    result = await import_hotel_result(client, url)
+    if "spot" in result: set_cache(f"rakuten_import_v3:{url}", result)
+
+async def resolve_hotel_nos(client, items: List[str]) -> List[Optional[str]]:
+    """URL (またはホテル番号) ごとのホテル番号。短縮URLのリダイレクト解決は8件ずつ並列"""
+    sem = asyncio.Semaphore(8)
+    async def resolve(item):
+        async with sem: return await resolve_rakuten_url(client, item)
+    return [extract_rakuten_hotel_no(u) for u in await asyncio.gather(*[resolve(item) for item in items])]
+
+async def refresh_imports(client, items: List[str]):
+    """鮮度切れの取込結果をまとめて取り直す (SimpleHotelSearch は最大15件ずつ)"""
+    hotel_nos = dict(zip(items, await resolve_hotel_nos(client, items)))
+    spots = await fetch_simple_hotels(client, [n for n in hotel_nos.values() if n]) if any(hotel_nos.values()) else {}
+    for item, hotel_no in hotel_nos.items():
+        if hotel_no in spots: set_cache(f"rakuten_import_v3:{item}", {"spot": spots[hotel_no]})
+
+@app.post("/api/import_rakuten_hotels")
+async def import_rakuten_hotels(req: BulkImportRequest):
+    """複数のURL/ホテル番号をまとめて取り込む (リダイレクト解決は並列、APIは最大15件ずつ)"""
+    if not RAKUTEN_APP_ID: 
+        return {"error": "サーバーの楽天APIキー設定が見つかりません。"}
     global http_client
-    if http_client is None: return {"error": "Server starting up..."}
+    if http_client is None: 
+        return {"error": "サーバーを準備中です。少し待ってから再度お試しください。"}
     client = http_client
 
-    cache_key = f"rakuten_vacant_v5:{req.latitude}:{req.longitude}:{req.hotel_no}:{req.checkin_date}:{req.checkout_date}:{req.adult_num}:{req.min_price}:{req.max_price}:{req.meal_type}:{req.hotel_type}:{req.min_rating}:{hashlib.md5(str(req.polygon).encode()).hexdigest() if req.polygon else 'all'}"
-    
-    if not req.force_refresh:
-        cached = get_cache(cache_key)
-        if cached: return cached
+    items = [u.strip() for u in req.urls if u and u.strip()][:BULK_IMPORT_MAX_ITEMS]
+    results: List[Optional[Dict]] = [None] * len(items)
+    pending = []
+    stale: Dict[str, str] = {} # キャッシュキー -> URL
+    for i, item in enumerate(items):
+        key = f"rakuten_import_v3:{item}"
+        cached = get_cache_swr(key, IMPORT_FRESH_SEC, None, req.force_refresh, IMPORT_MAX_STALE_SEC)
+        data = orjson.loads(cached[0]) if cached else None
+        if data and data.get("spot"):
+            results[i] = {"url": item, "spot": data["spot"]}
+            if cached[1]:
+                results[i]["stale"] = True
+                stale[key] = item
+        else: pending.append(i)
+    # 鮮度切れの分は1件ずつではなく、まとめて裏で取り直す (楽天の利用制限を1件ずつの呼び出しで使い切らない)
+    if stale: schedule_group_revalidation(list(stale), lambda keys: refresh_imports(client, [stale[k] for k in keys]))
+
+    try:
+        hotel_nos = dict(zip(pending, await resolve_hotel_nos(client, [items[i] for i in pending])))
+
+        spots = await fetch_simple_hotels(client, [n for n in hotel_nos.values() if n]) if any(hotel_nos.values()) else {}
+        for i in pending:
+            hotel_no = hotel_nos[i]
+            if not hotel_no:
+                results[i] = {"url": items[i], "error": "URLからホテルIDを特定できませんでした。"}
+            elif hotel_no not in spots:
+                results[i] = {"url": items[i], "error": f"該当するホテル情報が楽天APIに見つかりませんでした。 (ID: {hotel_no})"}
+            else:
+                results[i] = {"url": items[i], "spot": spots[hotel_no]}
+                set_cache(f"rakuten_import_v3:{items[i]}", {"spot": spots[hotel_no]})
+    except Exception as e:
+        print(f"Bulk Import Error: {e}")
+        for i in pending:
+            if results[i] is None: results[i] = {"url": items[i], "error": f"取込処理中に予期せぬエラーが発生しました: {str(e)}"}
 
+    return {"results": results, "spots": [r["spot"] for r in results if r and "spot" in r]}
+
+RAKUTEN_VACANT_URL = "https://app.rakuten.co.jp/services/api/Travel/VacantHotelSearch/20170426"
+
+def vacant_cache_key(req: VacantSearchRequest) -> str:
+    key = f"rakuten_vacant_v5:{req.latitude}:{req.longitude}:{req.hotel_no}:{req.checkin_date}:{req.checkout_date}:{req.adult_num}:{req.min_price}:{req.max_price}:{req.meal_type}:{req.hotel_type}:{req.min_rating}:{hashlib.md5(str(req.polygon).encode()).hexdigest() if req.polygon else 'all'}"
+    # ページ数を絞った検索 (カレンダー等) は通常の検索結果と混ざらないよう別キーにする
+    if req.max_pages != 5: key += f":p{req.max_pages}"
+    return key
+
+def vacant_base_params(req: VacantSearchRequest) -> Dict[str, Any]:
     safe_radius = min(round(req.radius, 2), 3.0)
     today = date.today()
     c_in = req.checkin_date or (today + timedelta(days=30)).strftime("%Y-%m-%d")
@@ -774,134 +2054,557 @@ async def search_hotels_vacant(req: VacantSearchRequest):
     elif req.meal_type == 'half_board': 
         base_params["breakfastFlag"] = 1
         base_params["dinnerFlag"] = 1
+    return base_params
+
+def best_plan(hotel_content: list) -> Optional[Dict]:
+    """VacantHotelSearchのroomInfo群から最安プランを返す (有効なプランがなければNone)"""
+    best = None
+    for j in range(1, len(hotel_content)):
+        r_info = hotel_content[j].get("roomInfo")
+        if isinstance(r_info, list) and len(r_info) >= 2:
+            r_basic = r_info[0].get("roomBasicInfo", {})
+            r_charge = r_info[1].get("dailyCharge")
+            if r_charge and r_charge.get("total", 0) > 0 and (best is None or r_charge["total"] < best["price"]):
+                best = {
+                    "price": int(r_charge["total"]), "plan_name": r_basic.get("planName"),
+                    "room_name": r_basic.get("roomName"), "reserve_url": r_basic.get("reserveUrl")
+                }
+    return best
 
-    url = "https://app.rakuten.co.jp/services/api/Travel/VacantHotelSearch/20170426"
+def best_plan_price(hotel_content: list) -> Optional[int]:
+    plan = best_plan(hotel_content)
+    return plan["price"] if plan else None
 
+async def fetch_vacant_pages(client, base_params: Dict[str, Any], max_pages: int = 5) -> List[Dict]:
     async def fetch_page(page_num):
         try:
             p = base_params.copy()
             p["page"] = page_num
-            res = await fetch_with_retry(client, url, params=p, initial_timeout=15.0, retries=5)
+            res = await fetch_with_retry(client, RAKUTEN_VACANT_URL, params=p, initial_timeout=15.0, retries=5, limiter=rakuten_limiter)
             if res and res.status_code == 200: return res.json()
         except: pass
         return None
 
-    try:
-        # ★修正箇所：API利用制限（429エラー）を完全に防ぐためのブレイク処理
-        results = []
-        for i in range(1, 6):
-            res_data = await fetch_page(i)
-            if res_data:
-                results.append(res_data)
-                # 楽天APIが返す「全体のページ数」を取得
-                paging_info = res_data.get("pagingInfo")
-                # もし現在のページが最大ページ数以上なら、これ以上無駄なループをしない
-                if paging_info and i >= paging_info.get("pageCount", 1):
-                    break
-                await asyncio.sleep(0.5)
-            else:
-                # データがない(404エラーなど)場合は、以降のページも存在しないので即終了
+    # 楽天APIの利用制限（429エラー）は共有の rakuten_limiter で間隔を空けて防ぐ
+    results = []
+    for i in range(1, max_pages + 1):
+        res_data = await fetch_page(i)
+        if res_data:
+            results.append(res_data)
+            # 楽天APIが返す「全体のページ数」を取得
+            paging_info = res_data.get("pagingInfo")
+            # もし現在のページが最大ページ数以上なら、これ以上無駄なループをしない
+            if paging_info and i >= paging_info.get("pageCount", 1):
                 break
+        else:
+            # データがない(404エラーなど)場合は、以降のページも存在しないので即終了
+            break
+    return results
 
-        all_hotels = []
-        seen_ids = set()
+async def run_vacant_search(client, req: VacantSearchRequest) -> Dict[str, Any]:
+    """楽天の空室検索を実行して整形済みの結果を返す (キャッシュは呼び出し側で扱う)"""
+    results = await fetch_vacant_pages(client, vacant_base_params(req), req.max_pages)
 
-        for data in results:
-            if not data or "hotels" not in data: continue
-            for h_group in data["hotels"]:
-                try:
-                    hotel_content = h_group["hotel"] if "hotel" in h_group else h_group
-                    if not isinstance(hotel_content, list) or len(hotel_content) == 0: continue
-                    
-                    basic = next((item["hotelBasicInfo"] for item in hotel_content if "hotelBasicInfo" in item), None)
-                    if not basic: continue
-                    
-                    hotel_id = str(basic["hotelNo"])
-                    if hotel_id in seen_ids: continue
-                    
-                    if req.polygon and not is_inside_polygon(basic["latitude"], basic["longitude"], req.polygon): continue
-
-                    best_price = float('inf')
-                    found_valid_plan = False
-                    for j in range(1, len(hotel_content)):
-                        r_info = hotel_content[j].get("roomInfo")
-                        if isinstance(r_info, list) and len(r_info) >= 2:
-                            r_basic = r_info[0].get("roomBasicInfo", {})
-                            r_charge = r_info[1].get("dailyCharge")
-                            
-                            if r_charge and r_charge.get("total", 0) > 0:
-                                if r_charge["total"] < best_price:
-                                    best_price = r_charge["total"]
-                                    found_valid_plan = True
-
-                    if not found_valid_plan: continue
-                    
-                    rating = basic.get("reviewAverage") or 0.0
-                    reviews = basic.get("reviewCount") or 0
-                    if rating < (req.min_rating or 0) or reviews < (req.min_reviews or 0):
-                        continue
+    all_hotels = []
+    seen_ids = set()
+    inventory_rows = {}
+
+    for data in results:
+        if not data or "hotels" not in data: continue
+        for h_group in data["hotels"]:
+            try:
+                hotel_content = h_group["hotel"] if "hotel" in h_group else h_group
+                if not isinstance(hotel_content, list) or len(hotel_content) == 0: continue
+                
+                basic = next((item["hotelBasicInfo"] for item in hotel_content if "hotelBasicInfo" in item), None)
+                if not basic: continue
+                
+                hotel_id = str(basic["hotelNo"])
+                if hotel_id in seen_ids: continue
+                if hotel_id not in inventory_rows: inventory_rows[hotel_id] = hotel_row_from_rakuten(basic)
+                
+                if req.polygon and not is_inside_polygon(basic["latitude"], basic["longitude"], req.polygon): continue
+
+                best_price = best_plan_price(hotel_content)
+                if best_price is None: continue
+                if inventory_rows.get(hotel_id): inventory_rows[hotel_id]["last_price"] = best_price
+                
+                rating = basic.get("reviewAverage") or 0.0
+                reviews = basic.get("reviewCount") or 0
+                if rating < (req.min_rating or 0) or reviews < (req.min_reviews or 0):
+                    continue
+
+                h_name = basic["hotelName"]
+                if req.hotel_type == "hotel" and "旅館" in h_name: continue
+                if req.hotel_type == "ryokan" and "ホテル" in h_name: continue
+
+                address = f"{basic.get('address1', '')}{basic.get('address2', '')}"
+                address = re.sub(r'[一-龠ぁ-んァ-ン]{1,6}郡', '', address)
+
+                all_hotels.append({
+                    "id": hotel_id, 
+                    "name": h_name, 
+                    "description": address, 
+                    "coordinates": [basic["longitude"], basic["latitude"]], 
+                    "image_url": basic.get("hotelImageUrl"), 
+                    "url": basic.get("hotelInformationUrl"), 
+                    "price": best_price, 
+                    "rating": rating,
+                    "review_count": reviews,
+                    "source": "rakuten", 
+                    "is_hotel": True, 
+                    "status": "hotel_candidate", 
+                    "comment": basic.get("hotelSpecial", "")[:60] + "..." 
+                })
+                seen_ids.add(hotel_id)
+            except: continue
+
+    upsert_hotels(list(inventory_rows.values()))
+    return {"hotels": all_hotels}
+
+async def refresh_vacant(client, req: VacantSearchRequest):
+    result = await run_vacant_search(client, req)
+    if result["hotels"]: set_cache(vacant_cache_key(req), result)
+
+async def get_vacant_result(client, req: VacantSearchRequest) -> Dict[str, Any]:
+    """キャッシュを優先して空室検索の結果を返す (カレンダー等の内部利用向け)"""
+    if req.max_pages < 5:
+        # 通常の空室検索 (5ページ) の結果は少ページの結果を含むので、新しいものがあれば先にそちらを使う
+        full = get_cache_entry(vacant_cache_key(req.model_copy(update={"max_pages": 5})))
+        if full and time.time() - full[1] <= VACANT_FRESH_SEC: return orjson.loads(full[0])
+    cache_key = vacant_cache_key(req)
+    cached = get_cache_swr(cache_key, VACANT_FRESH_SEC, lambda: refresh_vacant(client, req), max_stale_sec=VACANT_MAX_STALE_SEC)
+    if cached: return orjson.loads(cached[0])
+    result = await run_vacant_search(client, req)
+    if result["hotels"]: set_cache(cache_key, result)
+    return result
+
+# --- 空室検索結果のソート・ページング ---
+class HotelRecord:
+    """空室検索結果1件のコンパクトな表現。ソート・絞り込みはこれで行い、返すページ分だけdictに戻す"""
+    __slots__ = ("id", "name", "description", "lng", "lat", "image_url", "url",
+                 "price", "rating", "review_count", "comment", "distance_km")
+
+    def __init__(self, h: Dict[str, Any]):
+        self.id = h["id"]; self.name = h["name"]; self.description = h.get("description")
+        self.lng, self.lat = h["coordinates"]
+        self.image_url = h.get("image_url"); self.url = h.get("url")
+        self.price = h.get("price") or 0
+        self.rating = h.get("rating") or 0.0
+        self.review_count = h.get("review_count") or 0
+        self.comment = h.get("comment", "")
+        self.distance_km = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id, "name": self.name, "description": self.description,
+            "coordinates": [self.lng, self.lat], "image_url": self.image_url, "url": self.url,
+            "price": self.price, "rating": self.rating, "review_count": self.review_count,
+            "distance_km": round(self.distance_km, 2),
+            "source": "rakuten", "is_hotel": True, "status": "hotel_candidate", "comment": self.comment
+        }
+
+HOTEL_SORT_KEYS = {
+    # ソートキー: (値の取り出し, 既定で降順か)
+    "price": (lambda h: h.price, False),
+    "rating": (lambda h: h.rating, True),
+    "review_count": (lambda h: h.review_count, True),
+    "distance": (lambda h: h.distance_km, False),
+}
 
-                    h_name = basic["hotelName"]
-                    if req.hotel_type == "hotel" and "旅館" in h_name: continue
-                    if req.hotel_type == "ryokan" and "ホテル" in h_name: continue
-
-                    address = f"{basic.get('address1', '')}{basic.get('address2', '')}"
-                    address = re.sub(r'[一-龠ぁ-んァ-ン]{1,6}郡', '', address)
-
-                    all_hotels.append({
-                        "id": hotel_id, 
-                        "name": h_name, 
-                        "description": address, 
-                        "coordinates": [basic["longitude"], basic["latitude"]], 
-                        "image_url": basic.get("hotelImageUrl"), 
-                        "url": basic.get("hotelInformationUrl"), 
-                        "price": int(best_price), 
-                        "rating": rating,
-                        "review_count": reviews,
-                        "source": "rakuten", 
-                        "is_hotel": True, 
-                        "status": "hotel_candidate", 
-                        "comment": basic.get("hotelSpecial", "")[:60] + "..." 
-                    })
-                    seen_ids.add(hotel_id)
-                except: continue
-
-        final_result = {"hotels": all_hotels}
-        if all_hotels: set_cache(cache_key, final_result)
-        return final_result
+# (キャッシュキー, 内容のハッシュ) -> {"all": [HotelRecord], (sort_by, descending): [並べ替え済み]}
+hotel_result_sets: "OrderedDict[Tuple[str, str], Dict[Any, List[HotelRecord]]]" = OrderedDict()
+
+def hotel_result_set(cache_key: str, version: str, body: Optional[bytes], center: List[float]) -> Optional[Dict[Any, List[HotelRecord]]]:
+    """結果セットを1回だけデコードしてレコード化する (続きのページは同じセットから切り出す)"""
+    key = (cache_key, version)
+    entry = hotel_result_sets.get(key)
+    if entry is not None:
+        hotel_result_sets.move_to_end(key)
+        return entry
+    if body is None: return None
+    records = [HotelRecord(h) for h in orjson.loads(body).get("hotels", [])]
+    if records:
+        dists = haversine_to_point([[h.lng, h.lat] for h in records], center)
+        for h, d in zip(records, dists.tolist()): h.distance_km = d
+    entry = {"all": records}
+    hotel_result_sets[key] = entry
+    while len(hotel_result_sets) > HOTEL_RESULT_SETS_MAX: hotel_result_sets.popitem(last=False)
+    return entry
+
+def sorted_hotels(entry: Dict[Any, List[HotelRecord]], sort_by: Optional[str], descending: bool) -> List[HotelRecord]:
+    if sort_by not in HOTEL_SORT_KEYS: return entry["all"]
+    view = entry.get((sort_by, descending))
+    if view is None:
+        # 同値の時は楽天の並び順を保つ (安定ソート)
+        view = sorted(entry["all"], key=HOTEL_SORT_KEYS[sort_by][0], reverse=descending)
+        entry[(sort_by, descending)] = view
+    return view
+
+def encode_hotel_cursor(state: Dict[str, Any]) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps(state)).decode("ascii").rstrip("=")
+
+def is_number(v: Any) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+def decode_hotel_cursor(cursor: str) -> Optional[Dict[str, Any]]:
+    """カーソルを復元する。クライアントが手を加えられる値なので、各項目の型と範囲まで確かめる"""
+    try: state = orjson.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception: return None
+    if not isinstance(state, dict) or not isinstance(state.get("k"), str) or not isinstance(state.get("v"), str): return None
+    if not isinstance(state.get("o"), int) or isinstance(state["o"], bool) or state["o"] < 0: return None
+    if state.get("s") is not None and state["s"] not in HOTEL_SORT_KEYS: return None
+    if not isinstance(state.get("d"), bool): return None
+    if state.get("m") is not None and (not is_number(state["m"]) or state["m"] < 0): return None
+    return state
+
+def hotel_page_response(req: VacantSearchRequest, cache_key: str, body: bytes, stale: bool, request: Request) -> Response:
+    """キャッシュ済みの結果セットから1ページ分を返す。カーソルにはソート条件と結果セットの版を持たせる"""
+    version = hashlib.md5(body).hexdigest()[:12]
+    key_tag = hashlib.md5(cache_key.encode()).hexdigest()[:8]
+    sort_by, descending, max_dist, offset = req.sort_by, req.descending, req.max_distance_km, 0
+    if req.cursor:
+        state = decode_hotel_cursor(req.cursor)
+        if not state or state.get("k") != key_tag: return JSONResponse({"error": "カーソルが不正です。"}, status_code=400)
+        sort_by, descending, max_dist, offset = state.get("s"), state["d"], state.get("m"), state["o"]
+        # ページ送り中に裏で結果が更新されても最初のページと同じ版から切り出す。その版がメモリから消えていたら
+        # 別の版に切り替えると並びがずれて重複・欠落が出るので、最初から検索し直してもらう
+        if state["v"] != version:
+            if hotel_result_set(cache_key, state["v"], None, []) is None:
+                return JSONResponse({"error": "カーソルの有効期限が切れました。最初のページから検索し直してください。", "cursor_expired": True}, status_code=410)
+            version = state["v"]
+    if sort_by is not None and sort_by not in HOTEL_SORT_KEYS:
+        return JSONResponse({"error": f"sort_by は {', '.join(HOTEL_SORT_KEYS)} のいずれかを指定してください。"}, status_code=400)
+    if descending is None: descending = HOTEL_SORT_KEYS[sort_by][1] if sort_by else False
+
+    entry = hotel_result_set(cache_key, version, body, [req.longitude, req.latitude])
+    hotels = sorted_hotels(entry, sort_by, descending)
+    if max_dist is not None: hotels = [h for h in hotels if h.distance_km <= max_dist]
+
+    page_size = max(1, min(req.page_size, HOTEL_PAGE_MAX_SIZE))
+    page = hotels[offset:offset + page_size]
+    next_offset = offset + len(page)
+    next_cursor = encode_hotel_cursor({"k": key_tag, "v": version, "s": sort_by, "d": descending, "m": max_dist, "o": next_offset}) if next_offset < len(hotels) else None
+
+    data: Dict[str, Any] = {"hotels": [h.to_dict() for h in page], "total": len(hotels), "next_cursor": next_cursor}
+    if stale: data["stale"] = True
+    seed = f"{cache_key}:{version}:{sort_by}:{descending}:{max_dist}:{offset}:{page_size}"
+    return json_bytes_response(dumps_json(data), request, seed, extra_headers={"X-Cache": "STALE"} if stale else None)
 
+@app.post("/api/search_hotels_vacant")
+async def search_hotels_vacant(req: VacantSearchRequest, request: Request):
+    if not RAKUTEN_APP_ID: return {"error": "サーバー設定エラー"}
+    global http_client
+    if http_client is None: return {"error": "Server starting up..."}
+    client = http_client
+
+    cache_key = vacant_cache_key(req)
+    
+    # force_refresh や鮮度切れの時もキャッシュを即座に返し、楽天への再検索は裏で行う
+    cached = get_cache_swr(cache_key, VACANT_FRESH_SEC, lambda: refresh_vacant(client, req), req.force_refresh and not req.cursor, VACANT_MAX_STALE_SEC)
+    if cached:
+        if req.page_size: return hotel_page_response(req, cache_key, cached[0], cached[1], request)
+        return swr_response(cache_key, cached, request)
+
+    ticket = await admit("rakuten", request)
+    if isinstance(ticket, Response): return ticket
+    try:
+        result = await run_vacant_search(client, req)
+        if req.page_size:
+            body = dumps_json(result)
+            if result["hotels"]: set_cache_bytes(cache_key, body)
+            return hotel_page_response(req, cache_key, body, False, request)
+        return store_and_respond(cache_key, result, store=bool(result["hotels"]), request=request)
     except Exception as e:
         traceback.print_exc()
         return {"error": f"システムエラー: {str(e)}"}
+    finally:
+        ticket.release()
+
+def availability_cache_key(hotel_no: str, req: BatchAvailabilityRequest, c_in: str, c_out: str) -> str:
+    return f"rakuten_avail_v1:{hotel_no}:{c_in}:{c_out}:{req.adult_num}:{req.meal_type}:{req.min_price}:{req.max_price}"
+
+async def fetch_availability_group(client, hotel_nos: List[str], base_params: Dict[str, Any]) -> Optional[Dict[str, Dict]]:
+    """最大15件のホテル番号を1回の空室検索で問い合わせる (通信失敗時はNone)"""
+    params = {**base_params, "hotelNo": ",".join(hotel_nos)}
+    found: Dict[str, Dict] = {}
+    for page in range(1, 3):
+        res = await fetch_with_retry(client, RAKUTEN_VACANT_URL, params={**params, "page": page}, initial_timeout=15.0, retries=3, limiter=rakuten_limiter)
+        # 404 は「空室なし」。それ以外の失敗 (400 wrong_parameter 等) は結果不明として扱い、キャッシュさせない
+        if res is None: return None
+        if res.status_code == 404: break
+        if res.status_code != 200:
+            print(f"Availability API Error ({res.status_code}): {res.text[:200]}")
+            return None
+        data = res.json()
+        for h_group in data.get("hotels", []):
+            hotel_content = h_group["hotel"] if "hotel" in h_group else h_group
+            if not isinstance(hotel_content, list) or not hotel_content: continue
+            basic = next((item["hotelBasicInfo"] for item in hotel_content if "hotelBasicInfo" in item), None)
+            plan = best_plan(hotel_content)
+            if not basic or not plan: continue
+            hotel_id = str(basic["hotelNo"])
+            if hotel_id in found and found[hotel_id]["price"] <= plan["price"]: continue
+            found[hotel_id] = {
+                "name": basic.get("hotelName"), "image_url": basic.get("hotelImageUrl"),
+                "rating": basic.get("reviewAverage"), "review_count": basic.get("reviewCount"),
+                "_row": hotel_row_from_rakuten(basic, price=plan["price"]), **plan
+            }
+        paging_info = data.get("pagingInfo")
+        if not paging_info or page >= paging_info.get("pageCount", 1): break
+    upsert_hotels([f.pop("_row") for f in found.values()])
+    return found
+
+async def refresh_availability(client, keys: Dict[str, str], base_params: Dict[str, Any]):
+    """鮮度切れの空室情報を最大15件ずつまとめて取り直す (keys: ホテル番号 -> キャッシュキー)"""
+    hotel_nos = list(keys)
+    groups = [hotel_nos[i:i + RAKUTEN_MULTI_HOTEL_LIMIT] for i in range(0, len(hotel_nos), RAKUTEN_MULTI_HOTEL_LIMIT)]
+    for group, found in zip(groups, await asyncio.gather(*[fetch_availability_group(client, g, base_params) for g in groups], return_exceptions=True)):
+        if isinstance(found, Exception) or found is None: continue
+        for no in group: set_cache(keys[no], {"hotel_no": no, "available": no in found, **found.get(no, {})})
+
+@app.post("/api/hotels_availability")
+async def hotels_availability(req: BatchAvailabilityRequest):
+    """複数ホテルの空室と最安プランを1リクエストで返す (比較画面用)"""
+    if not RAKUTEN_APP_ID: return {"error": "サーバー設定エラー"}
+    global http_client
+    if http_client is None: return {"error": "Server starting up..."}
+    client = http_client
+
+    hotel_nos = list(dict.fromkeys(str(n).strip() for n in req.hotel_nos if str(n).strip().isdigit()))[:BATCH_AVAILABILITY_MAX_HOTELS]
+    base_params = vacant_base_params(VacantSearchRequest(
+        latitude=0.0, longitude=0.0, checkin_date=req.checkin_date, checkout_date=req.checkout_date,
+        adult_num=req.adult_num, meal_type=req.meal_type, min_price=req.min_price, max_price=req.max_price
+    ))
+    base_params.pop("latitude", None); base_params.pop("longitude", None); base_params.pop("searchRadius", None)
+    c_in, c_out = base_params["checkinDate"], base_params["checkoutDate"]
+
+    results: Dict[str, Dict] = {}
+    missing = []
+    stale: Dict[str, str] = {} # キャッシュキー -> ホテル番号
+    for no in hotel_nos:
+        key = availability_cache_key(no, req, c_in, c_out)
+        cached = get_cache_swr(key, AVAILABILITY_FRESH_SEC, None, req.force_refresh, AVAILABILITY_MAX_STALE_SEC)
+        if cached:
+            results[no] = orjson.loads(cached[0])
+            if cached[1]:
+                results[no]["stale"] = True
+                stale[key] = no
+        else: missing.append(no)
+    # 鮮度切れの分は15件ずつまとめて裏で取り直す
+    if stale: schedule_group_revalidation(list(stale), lambda keys: refresh_availability(client, {stale[k]: k for k in keys}, base_params))
+
+    groups = [missing[i:i + RAKUTEN_MULTI_HOTEL_LIMIT] for i in range(0, len(missing), RAKUTEN_MULTI_HOTEL_LIMIT)]
+    group_results = await asyncio.gather(*[fetch_availability_group(client, g, base_params) for g in groups], return_exceptions=True)
+    for group, found in zip(groups, group_results):
+        if isinstance(found, Exception) or found is None:
+            if isinstance(found, Exception): print(f"Availability Error: {found}")
+            for no in group: results[no] = {"hotel_no": no, "available": None, "error": "楽天APIから情報を取得できませんでした。"}
+            continue
+        for no in group:
+            item = {"hotel_no": no, "available": no in found, **found.get(no, {})}
+            results[no] = item
+            set_cache(availability_cache_key(no, req, c_in, c_out), item)
+
+    return {"checkin_date": c_in, "checkout_date": c_out, "results": [results[no] for no in hotel_nos]}
+
+@app.post("/api/hotel_price_calendar")
+async def hotel_price_calendar(req: PriceCalendarRequest):
+    """日付ごとの空室検索を並列実行し、ホテル×日付の最安料金マトリクスを返す"""
+    if not RAKUTEN_APP_ID: return {"error": "サーバー設定エラー"}
+    global http_client
+    if http_client is None: return {"error": "Server starting up..."}
+    if not req.hotel_no and (req.latitude is None or req.longitude is None):
+        return {"error": "場所またはホテル番号を指定してください。"}
+    client = http_client
+
+    try:
+        start = date.fromisoformat(req.start_date)
+        end = date.fromisoformat(req.end_date) if req.end_date else start + timedelta(days=req.nights - 1)
+    except ValueError:
+        return {"error": "日付の形式が正しくありません。"}
+    days = min((end - start).days + 1, PRICE_CALENDAR_MAX_DAYS)
+    if days <= 0: return {"error": "日付の範囲が正しくありません。"}
+    dates = [start + timedelta(days=i) for i in range(days)]
+
+    sem = asyncio.Semaphore(PRICE_CALENDAR_CONCURRENCY)
+    # ホテル番号指定は特定の1軒を見たいので、評価・レビュー数の既定の絞り込みはかけない
+    min_rating, min_reviews = (None, None) if req.hotel_no else (req.min_rating, req.min_reviews)
+    async def search_date(d: date):
+        day_req = VacantSearchRequest(
+            latitude=req.latitude or 0.0, longitude=req.longitude or 0.0, radius=req.radius,
+            hotel_no=req.hotel_no, min_price=req.min_price, max_price=req.max_price,
+            checkin_date=d.isoformat(), checkout_date=(d + timedelta(days=req.stay_nights)).isoformat(),
+            adult_num=req.adult_num, meal_type=req.meal_type, polygon=req.polygon,
+            min_rating=min_rating, min_reviews=min_reviews, hotel_type=req.hotel_type,
+            max_pages=1 if req.hotel_no else req.max_pages
+        )
+        async with sem:
+            try: return await get_vacant_result(client, day_req)
+            except Exception as e:
+                print(f"Calendar search error ({d}): {e}")
+                return {"hotels": []}
+
+    day_results = await asyncio.gather(*[search_date(d) for d in dates])
+
+    hotel_index: Dict[str, int] = {}
+    hotels = []
+    prices: List[List[Optional[int]]] = []
+    for col, result in enumerate(day_results):
+        for h in result.get("hotels", []):
+            row = hotel_index.get(h["id"])
+            if row is None:
+                row = hotel_index[h["id"]] = len(hotels)
+                hotels.append({k: h.get(k) for k in ("id", "name", "coordinates", "rating", "review_count", "image_url", "url")})
+                prices.append([None] * days)
+            prices[row][col] = h["price"]
+
+    cheapest = []
+    for col in range(days):
+        best = min(((prices[r][col], hotels[r]["id"]) for r in range(len(hotels)) if prices[r][col] is not None), default=None)
+        cheapest.append({"price": best[0], "hotel_id": best[1]} if best else None)
+
+    return {"dates": [d.isoformat() for d in dates], "hotels": hotels, "prices": prices, "cheapest": cheapest}
+
+@app.post("/api/local_hotels")
+async def local_hotels(req: LocalHotelSearchRequest):
+    """楽天を呼ばずにローカル在庫だけで地図表示・絞り込みに答える (空室・最新料金は search_hotels_vacant で更新)"""
+    if req.bbox and len(req.bbox) == 4:
+        min_lng, min_lat, max_lng, max_lat = req.bbox
+    elif req.polygon:
+        min_lng, max_lng = min(p[0] for p in req.polygon), max(p[0] for p in req.polygon)
+        min_lat, max_lat = min(p[1] for p in req.polygon), max(p[1] for p in req.polygon)
+    elif req.latitude is not None and req.longitude is not None:
+        d_lat = req.radius / 111.0
+        d_lng = req.radius / (111.0 * max(math.cos(math.radians(req.latitude)), 0.01))
+        min_lat, max_lat = req.latitude - d_lat, req.latitude + d_lat
+        min_lng, max_lng = req.longitude - d_lng, req.longitude + d_lng
+    else:
+        return {"error": "検索範囲を指定してください。"}
+
+    rows = query_local_hotels(min_lng, min_lat, max_lng, max_lat, req.min_rating, req.min_reviews, req.max_price, limit=max(req.limit * 4, 200))
+    if rows and (req.polygon or not req.bbox):
+        coords = [[r["longitude"], r["latitude"]] for r in rows]
+        if req.polygon: keep = points_in_polygon(coords, req.polygon)
+        else: keep = haversine_to_point(coords, [req.longitude, req.latitude]) <= req.radius
+        rows = [r for r, k in zip(rows, keep) if k]
+    hotels = []
+    for row in rows:
+        if req.hotel_type == "hotel" and "旅館" in row["name"]: continue
+        if req.hotel_type == "ryokan" and "ホテル" in row["name"]: continue
+        hotels.append(hotel_spot_from_row(row))
+        if len(hotels) >= req.limit: break
+    return {"hotels": hotels}
+
 @app.post("/api/suggest_spots")
-async def suggest_spots(req: SuggestRequest):
-    return StreamingResponse(suggest_spots_generator(req), media_type="application/x-ndjson")
+async def suggest_spots(req: SuggestRequest, request: Request):
+    # 途中で切れたストリームの再開 (AIの候補リストが残っている) なら受付制御を通さない
+    if get_suggest_resume(suggest_cache_key(req, suggest_existing_names(req))).get("candidates"):
+        return StreamingResponse(suggest_spots_generator(req, request), media_type="application/x-ndjson")
+
+    ticket = await admit("ai", request)
+    if isinstance(ticket, Response): return ticket
+
+    async def stream():
+        try:
+            async for line in suggest_spots_generator(req, request): yield line
+        finally:
+            ticket.release()
+    # ストリームが始まる前に切断された場合も BackgroundTask 側で枠を返す
+    return StreamingResponse(stream(), media_type="application/x-ndjson", background=BackgroundTask(ticket.release))
+
+class ClientTaskScope:
+    """クライアント切断を監視し、切断されたら配下のタスク (外部API呼び出し) をすべて取り消す"""
+    def __init__(self, request: Optional[Request] = None, poll_interval: float = 0.5):
+        self.request = request
+        self.poll_interval = poll_interval
+        self.disconnected = False
+        self._tasks = set()
+        self._watcher = None
+
+    def __enter__(self):
+        if self.request is not None:
+            self._watcher = asyncio.create_task(self._watch())
+        return self
+
+    def __exit__(self, *exc):
+        self.cancel_all()
+        if self._watcher: self._watcher.cancel()
+        return False
+
+    def spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def cancel_all(self):
+        for task in list(self._tasks): task.cancel()
+
+    def pending(self) -> int:
+        return sum(not t.done() for t in self._tasks)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            if await self.request.is_disconnected():
+                self.disconnected = True
+                self.cancel_all()
+                return
+
+def suggest_existing_names(req: SuggestRequest) -> List[str]:
+    existing_names = []
+    for item in req.existing_spots:
+        if isinstance(item, dict): existing_names.append(item.get("name", ""))
+        elif isinstance(item, str): existing_names.append(item)
+        elif hasattr(item, "name"): existing_names.append(item.name)
+    return existing_names
+
+def suggest_cache_key(req: SuggestRequest, existing_names: List[str]) -> str:
+    digest = hashlib.md5(dumps_json([req.theme, req.area, sorted(existing_names)])).hexdigest()
+    return f"suggest_v1:{digest}"
+
+def get_suggest_resume(cache_key: str) -> Dict:
+    """切断されたストリームの再開用の記録 (SUGGEST_RESUME_TTL_SEC を過ぎたものは使わない)"""
+    entry = get_cache_entry(cache_key)
+    if not entry or time.time() - entry[1] > SUGGEST_RESUME_TTL_SEC: return {}
+    try: return orjson.loads(entry[0])
+    except Exception: return {}
 
 # ==========================================
 # 1. suggest_spots_generator 関数の書き換え
 # （main.py の 560行目付近にある同名の関数を以下に丸ごと置き換えてください）
 # ==========================================
 
-async def suggest_spots_generator(req: SuggestRequest):
+async def suggest_spots_generator(req: SuggestRequest, request: Optional[Request] = None):
     global http_client
     if http_client is None:
         print("❌ [AI Suggestion] Error: http_client is None")
-        yield json.dumps({"type": "error", "message": "Server starting..."}) + "\n"; return
+        yield ndjson_line({"type": "error", "message": "Server starting..."}); return
     client = http_client
     
     print(f"🤖 [AI Suggestion] Start generating spots for theme: '{req.theme}'")
-    yield json.dumps({"type": "status", "message": "AIが候補地をリストアップ中..."}) + "\n"
+    yield ndjson_line({"type": "status", "message": "AIが候補地をリストアップ中..."})
     
-    existing_names = []
-    for item in req.existing_spots:
-        if isinstance(item, dict): existing_names.append(item.get("name", ""))
-        elif isinstance(item, str): existing_names.append(item)
-        elif hasattr(item, "name"): existing_names.append(item.name)
+    existing_names = suggest_existing_names(req)
 
     print(f"   [AI Suggestion] Excluded existing spots: {len(existing_names)} items")
 
-    # ★JSON形式の指定をより厳格に修正
-    prompt = f"""
+    # 途中で切断されたストリームの結果は短期間だけ保存しておき、同じ条件の再リクエストで続きから再開する。
+    # 最後まで流し終えたら記録は消す (次のリクエストでは新しい提案を作る。位置情報は geo_v5 に残る)
+    cache_key = suggest_cache_key(req, existing_names)
+    partial = get_suggest_resume(cache_key)
+    completed = False
+    target_spots = partial.get("candidates") or []
+    # 候補名 -> ジオコーディング結果 (結果の name はGeoapify側の名称で候補名と一致しないことが多いので、候補名で持つ)
+    found = partial.get("found")
+    found_spots: Dict[str, Dict] = found if isinstance(found, dict) else {}
+
+    with ClientTaskScope(request) as scope:
+        try:
+            if not target_spots:
+                # ★JSON形式の指定をより厳格に修正
+                prompt = f"""
     場所: {req.theme}
     タスク: 観光客に人気の「超有名・王道観光スポット」を人気順に15個挙げてください。
     条件:
@@ -914,63 +2617,86 @@ async def suggest_spots_generator(req: SuggestRequest):
         ]
     }}
     """
-    target_spots = []
-    try:
-        print("   [AI Suggestion] Requesting to OpenAI API...")
-        ai_res = await aclient.chat.completions.create(
-            model="gpt-4o-mini", messages=[{"role": "user", "content": prompt}], response_format={"type": "json_object"}, max_tokens=1500
-        )
-        content = ai_res.choices[0].message.content
-        print(f"   [AI Suggestion] OpenAI response received. Parsing JSON...")
-        
-        json_data = json.loads(content)
-        raw_spots = json_data.get("spots", [])
-        print(f"   [AI Suggestion] Found {len(raw_spots)} spots from AI.")
-        
-        seen_names = set(existing_names)
-        for s in raw_spots:
-            if s["name"] not in seen_names: 
-                target_spots.append(s)
-                seen_names.add(s["name"])
-        target_spots = target_spots[:10]
-        
-        print(f"   [AI Suggestion] Final target spots for location fetch: {len(target_spots)} items")
-        yield json.dumps({"type": "candidates", "names": [s["name"] for s in target_spots], "message": "位置情報を照合中..."}) + "\n"
-    except Exception as e:
-        print(f"❌ [AI Suggestion] Error in OpenAI/JSON processing: {e}")
-        yield json.dumps({"type": "error", "message": f"AI生成エラー: {str(e)}"}) + "\n"; return
+                try:
+                    print("   [AI Suggestion] Requesting to OpenAI API...")
+                    ai_res = await scope.spawn(get_openai_client().chat.completions.create(
+                        model="gpt-4o-mini", messages=[{"role": "user", "content": prompt}], response_format={"type": "json_object"}, max_tokens=1500
+                    ))
+                    content = ai_res.choices[0].message.content
+                    print(f"   [AI Suggestion] OpenAI response received. Parsing JSON...")
+                    
+                    json_data = json.loads(content)
+                    raw_spots = json_data.get("spots", [])
+                    print(f"   [AI Suggestion] Found {len(raw_spots)} spots from AI.")
+                    
+                    seen_names = set(existing_names)
+                    for s in raw_spots:
+                        if s["name"] not in seen_names: 
+                            target_spots.append(s)
+                            seen_names.add(s["name"])
+                    target_spots = target_spots[:10]
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"❌ [AI Suggestion] Error in OpenAI/JSON processing: {e}")
+                    yield ndjson_line({"type": "error", "message": f"AI生成エラー: {str(e)}"}); return
+            else:
+                print(f"   [AI Suggestion] Reusing {len(target_spots)} cached candidates ({len(found_spots)} already located)")
 
-    found_count = 0
-    seen_coords = []
-    
-    async def fetch_and_enrich(spot_info):
-        print(f"   [AI Suggestion] 🔍 Fetching coordinates for: {spot_info['name']}")
-        res = await fetch_spot_coordinates(client, spot_info["name"], spot_info["search_query"])
-        if res:
-            print(f"   [AI Suggestion] ✅ Success: {spot_info['name']}")
-            if spot_info.get("summary"): res["comment"] = spot_info.get("summary")
-            res["category"] = spot_info.get("category", "観光スポット")
-            return res
-        print(f"   [AI Suggestion] ❌ Failed to get location for: {spot_info['name']}")
-        return None
+            print(f"   [AI Suggestion] Final target spots for location fetch: {len(target_spots)} items")
+            yield ndjson_line({"type": "candidates", "names": [s["name"] for s in target_spots], "message": "位置情報を照合中..."})
 
-    tasks = [fetch_and_enrich(s) for s in target_spots]
-    for future in asyncio.as_completed(tasks):
-        try:
-            res = await future
-            if res and res["coordinates"] != [0.0, 0.0]:
-                if res["coordinates"] in seen_coords: 
+            found_count = 0
+            # 座標の完全一致ではなく近接 (SUGGEST_DEDUP_METERS 以内) で同一地点とみなす
+            seen_coords = ProximityDeduper(SUGGEST_DEDUP_METERS)
+
+            def accept(res) -> bool:
+                if not res or res["coordinates"] == [0.0, 0.0]: return False
+                if not seen_coords.add(res["coordinates"]): 
                     print(f"   [AI Suggestion] ⚠️ Duplicate coordinates skipped for: {res['name']}")
-                    continue
-                seen_coords.append(res["coordinates"])
-                found_count += 1
-                yield json.dumps({"type": "spot_found", "spot": {**res, "stay_time": 90, "source": "ai", "is_hotel": False, "status": "candidate"}}) + "\n"
-        except Exception as e:
-            print(f"   [AI Suggestion] ❌ Error during async fetch: {e}")
-            continue
+                    return False
+                return True
+
+            for spot_info in target_spots:
+                res = found_spots.get(spot_info["name"])
+                if res and accept(res):
+                    found_count += 1
+                    yield ndjson_line({"type": "spot_found", "spot": {**res, "image_url": proxy_image_url(res.get("image_url")), "stay_time": 90, "source": "ai", "is_hotel": False, "status": "candidate"}})
             
-    print(f"🎯 [AI Suggestion] Process completed. Total valid spots: {found_count}")
-    yield json.dumps({"type": "done", "count": found_count}) + "\n"
+            # 残りの候補はまとめてジオコーディングし、解決した順に流す
+            pending_spots = [s for s in target_spots if s["name"] not in found_spots]
+            print(f"   [AI Suggestion] 🔍 Batch geocoding {len(pending_spots)} spots")
+            async for spot_info, res in geocode_spots_batch(client, pending_spots, scope.spawn):
+                try:
+                    if not res:
+                        print(f"   [AI Suggestion] ❌ Failed to get location for: {spot_info['name']}")
+                        continue
+                    print(f"   [AI Suggestion] ✅ Success: {spot_info['name']}")
+                    if spot_info.get("summary"): res["comment"] = spot_info.get("summary")
+                    res["category"] = spot_info.get("category", "観光スポット")
+                    found_spots[spot_info["name"]] = res
+                    if accept(res):
+                        found_count += 1
+                        yield ndjson_line({"type": "spot_found", "spot": {**res, "image_url": proxy_image_url(res.get("image_url")), "stay_time": 90, "source": "ai", "is_hotel": False, "status": "candidate"}})
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    print(f"   [AI Suggestion] ❌ Error during async fetch: {e}")
+                    
+            print(f"🎯 [AI Suggestion] Process completed. Total valid spots: {found_count}")
+            yield ndjson_line({"type": "done", "count": found_count})
+            completed = True
+        except (asyncio.CancelledError, GeneratorExit):
+            print(f"🛑 [AI Suggestion] Client disconnected. Cancelled {scope.pending()} pending lookups")
+            # 切断を検知して自分で取り消した場合は静かに終了する
+            if not scope.disconnected: raise
+        finally:
+            scope.cancel_all()
+            if completed:
+                delete_cache(cache_key)
+            elif target_spots:
+                # 切断時点までに見つかった結果 (found_spots) も保存する
+                set_cache(cache_key, {"candidates": target_spots, "found": found_spots})
 
 
 # ==========================================
@@ -985,10 +2711,13 @@ async def suggest_spots_generator(req: SuggestRequest):
 async def verify_spots(req: VerifyRequest):
     return {"spots": req.spots}
 
+def route_cache_key(ordered_spots, start_min, limit_min) -> str:
+    coords_str = ";".join([f"{s.coordinates[0]:.5f},{s.coordinates[1]:.5f}" for s in ordered_spots[:25]])
+    return f"route:{coords_str}:{start_min}:{limit_min}"
+
 async def calculate_route_fallback(client, ordered_spots, start_min, limit_min):
     if not ordered_spots: return {"error": "スポットがありません"}
-    coords_str = ";".join([f"{s.coordinates[0]:.5f},{s.coordinates[1]:.5f}" for s in ordered_spots[:25]])
-    cache_key = f"route:{coords_str}:{start_min}:{limit_min}"
+    cache_key = route_cache_key(ordered_spots, start_min, limit_min)
     cached = get_cache(cache_key)
     if cached: return cached
     calc_spots = ordered_spots[:25]
@@ -1016,24 +2745,35 @@ async def calculate_route_fallback(client, ordered_spots, start_min, limit_min):
 
 @app.post("/api/optimize_route")
 @app.post("/api/calculate_route")
-async def calculate_route_endpoint(req: OptimizeRequest):
+async def calculate_route_endpoint(req: OptimizeRequest, request: Request):
     spots = [s for s in req.spots if s.coordinates and len(s.coordinates) >= 2]
     if len(spots) < 2: return {"error": "2箇所以上必要"}
     global http_client
     if http_client is None: return {"error": "Server starting up..."}
     try: sh, sm = map(int, req.start_time.split(':')); eh, em = map(int, req.end_time.split(':')); start, limit = sh*60+sm, eh*60+em
     except: start, limit = 540, 1080
-    return await calculate_route_fallback(http_client, spots, start, limit)
+    cache_key = route_cache_key(spots, start, limit)
+    hit = cached_response(cache_key, request)
+    if hit: return hit
+    result = await calculate_route_fallback(http_client, spots, start, limit)
+    if "error" in result: return result
+    return json_bytes_response(dumps_json(result), request, cache_key)
 
 @app.get("/api/search_places")
-async def search_places(query: str, lat: Optional[float] = None, lng: Optional[float] = None):
+async def search_places(request: Request, query: str, lat: Optional[float] = None, lng: Optional[float] = None):
     global http_client
     if http_client is None: return {"results": []}
     client = http_client
     cache_key_raw = f"search_places_smart_v2:{query}:{lat}:{lng}"
-    cached_raw = get_cache(cache_key_raw)
-    if cached_raw: return cached_raw
-    async def execute_search(search_q):
+    hit = cached_response(cache_key_raw, request)
+    if hit: return hit
+
+    # まずローカル索引で答える (入力途中の1文字ごとに外部APIを呼ばない)
+    indexed = place_index.search(query, lat, lng, limit=5)
+    if len(indexed) >= PLACE_TYPEAHEAD_MIN_RESULTS:
+        return json_bytes_response(dumps_json({"results": indexed}), request)
+
+    async def geocode_search(search_q):
         local_results = []
         try:
             geo_url = "https://api.geoapify.com/v1/geocode/search"
@@ -1048,56 +2788,154 @@ async def search_places(query: str, lat: Optional[float] = None, lng: Optional[f
                     clean_fmt = get_clean_address(props)
                     local_results.append({"id": feat["properties"].get("place_id"), "name": name, "place_name": clean_fmt, "center": feat["geometry"]["coordinates"], "type": "location"})
         except: pass
-        if len(local_results) < 3:
-            try:
-                places_url = "https://api.geoapify.com/v2/places"
-                p_params = {"name": search_q, "apiKey": GEOAPIFY_API_KEY, "lang": "ja", "limit": 5}
-                if lat and lng: p_params["bias"] = f"proximity:{lng},{lat}"
-                res = await fetch_with_retry(client, places_url, params=p_params, initial_timeout=5.0)
-                if res and res.status_code == 200:
-                    data = res.json()
-                    for feat in data.get("features", []):
-                        props = feat["properties"]
-                        name = props.get("name", "")
-                        if not name: continue
-                        clean_fmt = get_clean_address(props)
-                        local_results.append({"id": feat["properties"].get("place_id"), "name": name, "place_name": clean_fmt, "center": feat["geometry"]["coordinates"], "type": "place"})
-            except: pass
         return local_results
-    results = await execute_search(query)
-    response_data = {"results": results}
-    set_cache(cache_key_raw, response_data)
-    return response_data
+
+    async def places_search(search_q):
+        local_results = []
+        try:
+            places_url = "https://api.geoapify.com/v2/places"
+            p_params = {"name": search_q, "apiKey": GEOAPIFY_API_KEY, "lang": "ja", "limit": 5}
+            if lat and lng: p_params["bias"] = f"proximity:{lng},{lat}"
+            res = await fetch_with_retry(client, places_url, params=p_params, initial_timeout=5.0)
+            if res and res.status_code == 200:
+                data = res.json()
+                for feat in data.get("features", []):
+                    props = feat["properties"]
+                    name = props.get("name", "")
+                    if not name: continue
+                    clean_fmt = get_clean_address(props)
+                    local_results.append({"id": feat["properties"].get("place_id"), "name": name, "place_name": clean_fmt, "center": feat["geometry"]["coordinates"], "type": "place"})
+        except: pass
+        return local_results
+
+    # 2つのGeoapify検索は並行して投げ、住所検索が3件未満の時だけ施設検索の結果を足す
+    geo_results, place_results = await asyncio.gather(geocode_search(query), places_search(query))
+    place_index.add(geo_results + place_results)
+    results = geo_results + (place_results if len(geo_results) < 3 else [])
+    seen = {r["id"] for r in results}
+    results += [r for r in indexed if r["id"] not in seen]
+    return store_and_respond(cache_key_raw, {"results": results}, request=request)
+
+async def run_task_graph(graph: Dict[str, Tuple[Tuple[str, ...], Any]]) -> Dict[str, Any]:
+    """依存関係つきのタスク群を、依存が揃ったものから並行に実行する。
+    graph は {名前: (依存する名前のタプル, async fn(results))} で、依存先を先に書くこと。
+    失敗したノードの結果は None になる。"""
+    results: Dict[str, Any] = {}
+    tasks: Dict[str, asyncio.Task] = {}
+
+    async def run(name, deps, fn):
+        if deps: await asyncio.gather(*(tasks[d] for d in deps))
+        try:
+            results[name] = await fn(results)
+        except Exception as e:
+            print(f"Task graph node '{name}' failed: {e}")
+            results[name] = None
+
+    for name, (deps, fn) in graph.items():
+        tasks[name] = asyncio.create_task(run(name, deps, fn))
+    try:
+        await asyncio.gather(*tasks.values())
+    finally:
+        for t in tasks.values(): t.cancel()
+    return results
+
+def find_local_spot(query: str, lat: float, lng: float) -> Optional[Dict]:
+    """ローカルPOIストアから、座標の近くにある同名スポットを探す。
+    「渋谷」「公園」のような短い名前が長いクエリに含まれるだけでは同名とみなさない"""
+    q = normalize_place_text(query)
+    if not q: return None
+    best, best_ratio = None, 0.0
+    for p in query_pois(lat, lng, SPOT_INFO_LOCAL_RADIUS_M, limit=10):
+        name = normalize_place_text(p["name"])
+        if not name: continue
+        short, long = sorted((q, name), key=len)
+        if q == name: ratio = 1.0
+        elif short in long and len(short) >= SPOT_INFO_MATCH_MIN_LEN: ratio = len(short) / len(long)
+        else: continue
+        if ratio >= SPOT_INFO_MATCH_MIN_RATIO and ratio > best_ratio: best, best_ratio = p, ratio
+    if best is None: return None
+    return {"name": best["name"], "description": best.get("address") or "", "coordinates": [best["longitude"], best["latitude"]],
+            "image_url": best.get("image_url"), "comment": best.get("comment") or ""}
+
+def is_invalid_address(desc: str) -> bool:
+    has_pref = any(p in desc for p in PREF_NORMALIZER.values())
+    return (not desc or "NN" in desc or "調査中" in desc or "不明" in desc or not has_pref)
+
+def spot_info_cached(query: str, lat: Optional[float], lng: Optional[float]) -> bool:
+    """get_spot_info が外部APIを呼ばずに答えられるか (受付制御を通さずに済むか)"""
+    if get_cache_entry(f"wiki_info_v4:{query}") is None: return False
+    candidates = []
+    if lat is not None and lng is not None:
+        candidates.append(find_local_spot(query, lat, lng))
+        candidates.append(get_cache(f"geo_reverse_v2:{round(lat, 6)}:{round(lng, 6)}"))
+    candidates.append(get_cache(f"geo_v5:{query}:{query}"))
+    return any(c and not is_invalid_address(c.get("description", "")) for c in candidates)
 
 @app.get("/api/get_spot_info")
-async def get_spot_info(query: str, lat: Optional[float] = None, lng: Optional[float] = None):
+async def get_spot_info(request: Request, query: str, lat: Optional[float] = None, lng: Optional[float] = None):
     global http_client
     if http_client is None: return {}
-    client = http_client
-    data = None
-    if lat is not None and lng is not None: data = await fetch_spot_by_coordinates(client, lat, lng, query)
-    if not data: data = await fetch_spot_coordinates(client, query, query)
-    current_desc = data.get("description", "") if data else ""
-    has_pref = any(p in current_desc for p in PREF_NORMALIZER.values())
-    is_invalid = (not current_desc or "NN" in current_desc or "調査中" in current_desc or "不明" in current_desc or not has_pref)
-    if is_invalid:
-        ai_data = await get_structured_address_by_ai(query, current_desc)
-        if ai_data.get("full_address"):
-            if not data: data = {"name": query, "coordinates": [lng or 0.0, lat or 0.0]}
-            data["description"] = ai_data["full_address"]
-    wiki = await fetch_wikipedia_info(client, query, target_name=query)
+    if spot_info_cached(query, lat, lng): return await build_spot_info(http_client, query, lat, lng)
+    ticket = await admit("geo", request)
+    if isinstance(ticket, Response): return ticket
+    try:
+        return await build_spot_info(http_client, query, lat, lng)
+    finally:
+        ticket.release()
+
+async def build_spot_info(client, query: str, lat: Optional[float], lng: Optional[float]) -> Dict[str, Any]:
+    has_coords = lat is not None and lng is not None
+
+    # 優先順位: ローカルPOI > 逆ジオコーディング > 正ジオコーディング。住所が不完全ならAIで補正。
+    # Wikipediaは query だけに依存するので最初から並行して取りに行く。
+    async def local(r):
+        if not has_coords: return None
+        spot = find_local_spot(query, lat, lng)
+        return spot if spot and not is_invalid_address(spot["description"]) else None
+
+    async def reverse(r):
+        if r["local"] or not has_coords: return None
+        return await fetch_spot_by_coordinates(client, lat, lng, query)
+
+    async def forward(r):
+        if r["local"] or r["reverse"]: return None
+        return await fetch_spot_coordinates(client, query, query)
+
+    async def address_ai(r):
+        data = r["local"] or r["reverse"] or r["forward"]
+        current_desc = data.get("description", "") if data else ""
+        if not is_invalid_address(current_desc): return None
+        return await get_structured_address_by_ai(query, current_desc)
+
+    async def wiki(r):
+        return await fetch_wikipedia_info(client, query, target_name=query)
+
+    r = await run_task_graph({
+        "local": ((), local),
+        "wiki": ((), wiki),
+        "reverse": (("local",), reverse),
+        "forward": (("reverse",), forward),
+        "address_ai": (("forward",), address_ai),
+    })
+
+    data = r["local"] or r["reverse"] or r["forward"]
+    ai_data = r["address_ai"] or {}
+    if ai_data.get("full_address"):
+        if not data: data = {"name": query, "coordinates": [lng or 0.0, lat or 0.0]}
+        data["description"] = ai_data["full_address"]
+    wiki_info = r["wiki"] or {}
     if data:
-        data["image_url"] = data.get("image_url") or wiki.get("image_url")
-        data["comment"] = data.get("comment") or wiki.get("summary") or ""
+        data["image_url"] = data.get("image_url") or wiki_info.get("image_url")
+        data["comment"] = data.get("comment") or wiki_info.get("summary") or ""
         return data
-    return {"name": query, "description": "", "image_url": wiki.get("image_url"), "comment": wiki.get("summary") or ""}
+    return {"name": query, "description": "", "image_url": wiki_info.get("image_url"), "comment": wiki_info.get("summary") or ""}
 
  # ==========================================
 # ホットペッパーグルメ検索API (ファイルの末尾に配置)
 # ==========================================
 @app.get("/api/search_hotpepper")
-async def search_hotpepper(query: str, lat: Optional[float] = None, lng: Optional[float] = None):
-    """ホットペッパーグルメAPIでの店舗検索 (周辺検索 -> 全国検索の2段構え)"""
+async def search_hotpepper(request: Request, query: str, lat: Optional[float] = None, lng: Optional[float] = None, page: int = 1, page_size: int = 10):
+    """ホットペッパーグルメAPIでの店舗検索 (周辺検索と全国検索を並行し、周辺に結果があれば全国検索は破棄)"""
     global http_client
 
     if not HOTPEPPER_API_KEY:
@@ -1106,10 +2944,53 @@ async def search_hotpepper(query: str, lat: Optional[float] = None, lng: Optiona
     if http_client is None: 
         return {"results": []}
 
-    cache_key = f"hotpepper_v2:{query}:{lat}:{lng}"
+    page = max(page, 1)
+    page_size = min(max(page_size, 1), HOTPEPPER_FETCH_COUNT)
+    try:
+        result_set = await get_hotpepper_result_set(http_client, query, lat, lng)
+    except Exception as e:
+        print(f"Hotpepper Search Error: {e}")
+        return {"results": []}
+
+    results = result_set["results"]
+    # 距離順の並べ替えは実際の中心点で行う (キャッシュはグリッド単位で共有)
+    if lat is not None and lng is not None:
+        results = sorted(results, key=lambda r: haversine_distance([lng, lat], [r["lng"], r["lat"]]))
+    start = (page - 1) * page_size
+    response_data = {
+        "results": results[start:start + page_size], "total": len(results),
+        "has_more": start + page_size < len(results), "scope": result_set.get("scope", "local")
+    }
+    return json_bytes_response(dumps_json(response_data), request, f"{result_set['key']}:{lat}:{lng}:{page}:{page_size}")
+
+def snap_to_grid(value: float, grid: float) -> float:
+    return round(round(value / grid) * grid, 6)
+
+def hotpepper_shop_to_result(shop: dict) -> Dict:
+    # 高画質な画像(photo.pc.l)があれば優先し、なければロゴ画像
+    image_url = shop.get("photo", {}).get("pc", {}).get("l") or shop.get("logo_image")
+    return {
+        "id": shop.get("id"),
+        "name": shop.get("name"),
+        "address": shop.get("address"),
+        "lat": float(shop.get("lat", 0)),
+        "lng": float(shop.get("lng", 0)),
+        "logo_image": image_url,
+        "is_hotpepper": True
+    }
+
+async def get_hotpepper_result_set(client, query: str, lat: Optional[float], lng: Optional[float], local_only: bool = False) -> Dict[str, Any]:
+    """グリッド単位でキャッシュしたホットペッパーの検索結果一式を返す (local_only なら全国検索にフォールバックしない)"""
+    has_location = lat is not None and lng is not None
+    if has_location:
+        cell_lat, cell_lng = snap_to_grid(lat, HOTPEPPER_GRID_DEG), snap_to_grid(lng, HOTPEPPER_GRID_DEG)
+        cache_key = f"hotpepper_v3:{query}:{cell_lat}:{cell_lng}"
+    else:
+        cache_key = f"hotpepper_v3:{query}:all"
     cached = get_cache(cache_key)
-    if cached: 
-        return cached
+    if cached:
+        if local_only and cached.get("scope") == "nationwide": return {"scope": "local", "results": [], "key": cache_key}
+        return {**cached, "key": cache_key}
 
     url = "https://webservice.recruit.co.jp/hotpepper/gourmet/v1/"
 
@@ -1119,54 +3000,321 @@ async def search_hotpepper(query: str, lat: Optional[float] = None, lng: Optiona
             "key": HOTPEPPER_API_KEY,
             "keyword": query,
             "format": "json",
-            "count": 10
+            "count": HOTPEPPER_FETCH_COUNT
         }
-        if use_location and lat is not None and lng is not None:
-            params["lat"] = lat
-            params["lng"] = lng
+        if use_location:
+            params["lat"] = cell_lat
+            params["lng"] = cell_lng
             params["range"] = 5 # 3000m圏内
 
-        res = await fetch_with_retry(http_client, url, params=params, initial_timeout=5.0)
+        res = await fetch_with_retry(client, url, params=params, initial_timeout=5.0)
         if res and res.status_code == 200:
             data = res.json()
-            return data.get("results", {}).get("shop", [])
+            return [hotpepper_shop_to_result(shop) for shop in data.get("results", {}).get("shop", [])]
         return []
 
-    try:
-        # 【ステップ1】まずは画面の中心点（lat/lng）を基準に周辺検索
-        shops = await fetch_hp(use_location=True)
-
-        # 【ステップ2】結果が0件で、かつ位置情報が指定されていた場合は「全国検索」に切り替え
-        if not shops and lat is not None and lng is not None:
-            print(f"🔄 周辺に見つからないため、全国検索に切り替えます: {query}")
-            shops = await fetch_hp(use_location=False)
-
-        results = []
-        for shop in shops:
-            # 高画質な画像(photo.pc.l)があれば優先し、なければロゴ画像
-            image_url = shop.get("photo", {}).get("pc", {}).get("l") or shop.get("logo_image")
-
-            results.append({
-                "id": shop.get("id"),
-                "name": shop.get("name"),
-                "address": shop.get("address"),
-                "lat": float(shop.get("lat", 0)),
-                "lng": float(shop.get("lng", 0)),
-                "logo_image": image_url,
-                "is_hotpepper": True
-            })
-
-        response_data = {"results": results}
-        
-        # 結果がある場合のみキャッシュ
+    scope = "local"
+    if has_location and local_only:
+        results = await fetch_hp(use_location=True)
+    elif has_location:
+        # 周辺検索と全国検索を同時に投げ、周辺に結果があれば全国検索は取り消す
+        nationwide_task = asyncio.create_task(fetch_hp(use_location=False))
+        try:
+            results = await fetch_hp(use_location=True)
+        except BaseException:
+            nationwide_task.cancel()
+            raise
         if results:
-            set_cache(cache_key, response_data)
-            
-        return response_data
+            nationwide_task.cancel()
+        else:
+            print(f"🔄 周辺に見つからないため、全国検索の結果を使います: {query}")
+            results = await nationwide_task
+            scope = "nationwide"
+    else:
+        results = await fetch_hp(use_location=False)
+        scope = "nationwide"
+
+    place_index.add([
+        {"id": f"hotpepper:{r['id']}", "name": r["name"], "place_name": r["address"], "center": [r["lng"], r["lat"]], "type": "gourmet"}
+        for r in results if r.get("lat") and r.get("lng")
+    ])
+    result_set = {"scope": scope, "results": results}
+    # 結果がある場合のみキャッシュ
+    if results: set_cache(cache_key, result_set)
+    return {**result_set, "key": cache_key}
+
+# ==========================================
+# 🛣️ ルート沿い検索 (グルメ・ホテル・観光スポット)
+# ==========================================
+class CorridorRequest(BaseModel):
+    route_geometry: Dict[str, Any] # optimize_route が返す GeoJSON LineString
+    corridor_m: int = Field(800, gt=0, le=CORRIDOR_MAX_SEARCH_RADIUS_M) # ルートからこの距離以内を対象にする
+    categories: List[str] = ["gourmet", "hotel", "spot"]
+    gourmet_query: str = ""
+    spot_mode: str = "standard"
+    checkin_date: Optional[str] = None # 指定時は楽天の空室検索、未指定ならローカルのホテル在庫から探す
+    checkout_date: Optional[str] = None
+    adult_num: int = 2
+    # ホテルの評価・レビュー数の絞り込み。日付の有無 (楽天の空室検索 / ローカル在庫) にかかわらず同じ条件を使い、既定は絞り込まない
+    min_rating: Optional[float] = None
+    min_reviews: Optional[int] = None
+    limit: int = 20 # カテゴリごとの件数
+
+def corridor_uncovered_ratio(spacing: float, radius: float, w: float) -> float:
+    """半径 radius の円を間隔 spacing で中心線上に並べた時、幅 2w の帯のうち円から外れる面積の割合。
+    中心から x 離れた位置で円が覆う半幅は √(R²-x²) なので、隣の円との中間 (x = s/2) まで数値積分する"""
+    if w <= 0 or spacing <= 0: return 0.0
+    steps = 64
+    half = spacing / 2
+    covered = sum(min(w, math.sqrt(max(radius ** 2 - (half * (k + 0.5) / steps) ** 2, 0.0))) for k in range(steps)) / steps
+    return max(0.0, 1 - covered / w)
+
+def corridor_samples(line, corridor_m: float) -> Tuple[List[List[float]], float, float, float]:
+    """ルート上の検索中心・検索半径 (m)・ルート全長 (km)・帯のうち覆えていない面積の割合を決める。
+    半径Rの円を間隔sで並べて幅wの帯を覆うには s <= 2√(R²-w²)。まず R=1.5w で並べ、
+    点数が CORRIDOR_MAX_SAMPLES を超える長いルートでは間隔を伸ばし、その分だけ半径を広げる。
+    半径が上限に当たったら CORRIDOR_SAMPLE_BUDGET 点まで増やして隙間を詰め、それでも残る隙間は割合で返す"""
+    w = corridor_m / 1000.0
+    reach = lambda r: 2 * math.sqrt(max(r ** 2 - w ** 2, 0.0)) # 半径rの円1つで帯を全幅覆えるルート上の長さ
+    radius = min(1.5 * w, CORRIDOR_MAX_SEARCH_RADIUS_M / 1000.0)
+    spacing = reach(radius)
+    _, total = sample_polyline(line, spacing or 1.0)
+    if spacing == 0 or total / spacing > CORRIDOR_MAX_SAMPLES - 1:
+        spacing = total / (CORRIDOR_MAX_SAMPLES - 1)
+        radius = min(math.sqrt((spacing / 2) ** 2 + w ** 2), CORRIDOR_MAX_SEARCH_RADIUS_M / 1000.0)
+        # 帯の幅が半径の上限に近いと全幅は覆えないので、その時は中心線に沿って円が重なる間隔にとどめる
+        if reach(radius) < spacing: spacing = max(reach(radius) or radius, total / (CORRIDOR_SAMPLE_BUDGET - 1))
+    points, total = sample_polyline(line, spacing)
+    gap = total / (len(points) - 1) if len(points) > 1 else 0.0
+    return points.tolist(), radius * 1000, total, corridor_uncovered_ratio(gap, radius, w)
+
+async def corridor_gourmet(client, samples: List[List[float]], query: str, sem: asyncio.Semaphore) -> List[Dict]:
+    # ホットペッパーのキャッシュはグリッド単位なので、同じセルに入るサンプル点は1回の検索で済む
+    cells = dict.fromkeys((snap_to_grid(lat, HOTPEPPER_GRID_DEG), snap_to_grid(lng, HOTPEPPER_GRID_DEG)) for lng, lat in samples)
+    async def one(lat, lng):
+        async with sem: return (await get_hotpepper_result_set(client, query, lat, lng, local_only=True))["results"]
+    merged: Dict[str, Dict] = {}
+    for found in await asyncio.gather(*[one(lat, lng) for lat, lng in cells], return_exceptions=True):
+        if isinstance(found, Exception):
+            print(f"Corridor Hotpepper Error: {found}")
+            continue
+        for shop in found:
+            if shop.get("id") and shop.get("lat") and shop.get("lng"):
+                merged.setdefault(shop["id"], {**shop, "coordinates": [shop["lng"], shop["lat"]]})
+    return list(merged.values())
+
+async def corridor_spots(client, samples: List[List[float]], radius_m: float, mode: str, sem: asyncio.Semaphore) -> List[Dict]:
+    # 取得済みの範囲はローカルPOIストアだけで答える (重なった円の再取得もカバー済みセルで防がれる)
+    async def one(lng, lat):
+        cells = poi_cells_in_radius(lat, lng, radius_m)
+        if poi_coverage_missing(mode, cells):
+            async with sem:
+                # 順番待ちの間に隣の円の取得でカバー済みになっていれば呼ばない
+                if poi_coverage_missing(mode, cells): await fetch_poi_area(client, lat, lng, radius_m, mode)
+        return query_pois(lat, lng, radius_m, mode, limit=POI_FETCH_LIMIT)
+    merged: Dict[str, Dict] = {}
+    for found in await asyncio.gather(*[one(lng, lat) for lng, lat in samples], return_exceptions=True):
+        if isinstance(found, Exception):
+            print(f"Corridor POI Error: {found}")
+            continue
+        for p in found: merged.setdefault(p["place_id"], poi_to_spot(p))
+    return list(merged.values())
+
+async def corridor_hotels(client, req: CorridorRequest, line, samples: List[List[float]], radius_m: float, sem: asyncio.Semaphore) -> List[Dict]:
+    if not req.checkin_date:
+        # 日付がなければローカルのホテル在庫をサンプル円ごとに引く (楽天は呼ばない)。
+        # ルート全体の外接矩形を1回引くと、評価順のLIMITをルートから離れたホテルに取られてしまう
+        def query_circles() -> List[Dict]:
+            rows: Dict[str, Dict] = {}
+            d_lat = radius_m / 111_195.0
+            for lng, lat in samples:
+                d_lng = d_lat / max(math.cos(math.radians(lat)), 0.1)
+                for row in query_local_hotels(lng - d_lng, lat - d_lat, lng + d_lng, lat + d_lat, req.min_rating, req.min_reviews):
+                    rows.setdefault(row["hotel_no"], row)
+            return list(rows.values())
+        return [hotel_spot_from_row(row) for row in await asyncio.to_thread(query_circles)]
+
+    # 楽天の空室検索は共有の rakuten_limiter を通るので、点数が多くても利用制限は超えない
+    centers = dict.fromkeys((round(lat, 3), round(lng, 3)) for lng, lat in samples)
+    async def one(lat, lng):
+        vreq = VacantSearchRequest(latitude=lat, longitude=lng, radius=radius_m / 1000.0, checkin_date=req.checkin_date,
+                                   checkout_date=req.checkout_date, adult_num=req.adult_num, max_pages=1,
+                                   min_rating=req.min_rating, min_reviews=req.min_reviews)
+        async with sem: return (await get_vacant_result(client, vreq))["hotels"]
+    merged: Dict[str, Dict] = {}
+    for found in await asyncio.gather(*[one(lat, lng) for lat, lng in centers], return_exceptions=True):
+        if isinstance(found, Exception):
+            print(f"Corridor Rakuten Error: {found}")
+            continue
+        for h in found: merged.setdefault(h["id"], h)
+    return list(merged.values())
+
+def rank_by_detour(items: List[Dict], line, corridor_m: float, limit: int) -> List[Dict]:
+    """ルートから外れる距離で絞り込み、寄り道 (往復) の短い順に並べる"""
+    if not items: return []
+    dist_km, along_km = point_to_polyline_km([item["coordinates"] for item in items], line)
+    ranked = []
+    for item, d, along in zip(items, dist_km.tolist(), along_km.tolist()):
+        if d * 1000 > corridor_m: continue
+        ranked.append({**item, "detour_km": round(2 * d, 2), "detour_min": math.ceil(2 * d / CORRIDOR_SPEED_KMH * 60),
+                       "route_position_km": round(along, 2)})
+    ranked.sort(key=lambda x: (x["detour_km"], -(x.get("rating") or 0)))
+    return ranked[:limit]
+
+@app.post("/api/route_corridor")
+async def route_corridor(req: CorridorRequest, request: Request):
+    """ルート沿いのグルメ・ホテル・観光スポットを1リクエストで集め、寄り道の少ない順に返す"""
+    global http_client
+    if http_client is None: return {"error": "Server starting up..."}
+    client = http_client
+    line = req.route_geometry.get("coordinates") or []
+    if len(line) < 2: return {"error": "route_geometry (LineString) を指定してください。"}
+
+    cache_key = "corridor_v3:" + hashlib.md5(dumps_json([line, req.model_dump(exclude={"route_geometry"})])).hexdigest()
+    hit = cached_response(cache_key, request)
+    if hit: return hit
+
+    samples, radius_m, total_km, uncovered = corridor_samples(line, req.corridor_m)
+    sem = asyncio.Semaphore(CORRIDOR_CONCURRENCY)
+    jobs = {}
+    if "gourmet" in req.categories and HOTPEPPER_API_KEY: jobs["gourmet"] = corridor_gourmet(client, samples, req.gourmet_query, sem)
+    if "hotel" in req.categories: jobs["hotels"] = corridor_hotels(client, req, line, samples, radius_m, sem)
+    if "spot" in req.categories: jobs["spots"] = corridor_spots(client, samples, radius_m, req.spot_mode, sem)
+
+    with ClientTaskScope(request) as scope:
+        done = await asyncio.gather(*[scope.spawn(job) for job in jobs.values()], return_exceptions=True)
+
+    result: Dict[str, Any] = {"route_km": round(total_km, 2), "samples": len(samples), "search_radius_m": round(radius_m),
+                              "uncovered_ratio": round(uncovered, 3)}
+    for name, items in zip(jobs, done):
+        if isinstance(items, BaseException):
+            print(f"Corridor Error ({name}): {items!r}")
+            items = []
+        result[name] = rank_by_detour(items, line, req.corridor_m, req.limit)
+    return store_and_respond(cache_key, result, store=not scope.disconnected, request=request)
+
+# ==========================================
+# 📦 バッチAPI (読み取り系エンドポイントを1往復でまとめて呼ぶ)
+# ==========================================
+class BatchSubRequest(BaseModel):
+    path: str # 例: "/api/get_spot_info"
+    params: Dict[str, Any] = {} # GETはクエリパラメータ、POSTはリクエストボディ
+
+class BatchRequest(BaseModel):
+    requests: List[BatchSubRequest]
+    stream: bool = False # TrueならNDJSONで完了順に返す
+
+def query_params_model(func):
+    """GETエンドポイントの引数からクエリパラメータ検証用のモデルを作る (Request型の引数は除く)"""
+    fields = {}
+    for name, param in inspect.signature(func).parameters.items():
+        if param.annotation is Request: continue
+        default = ... if param.default is inspect.Parameter.empty else param.default
+        fields[name] = (param.annotation, default)
+    return create_model(f"{func.__name__}_params", **fields)
+
+# パス -> (ハンドラ, 検証モデル, POSTボディとして渡すか)
+# 書き込み系 (取込)・ストリーミング (suggest_spots)・AI呼び出し (verify_spots) は対象外
+BATCH_ENDPOINTS: Dict[str, Tuple[Any, Any, bool]] = {
+    "/api/get_spot_image": (get_spot_image, query_params_model(get_spot_image), False),
+    "/api/get_spot_info": (get_spot_info, query_params_model(get_spot_info), False),
+    "/api/search_places": (search_places, query_params_model(search_places), False),
+    "/api/search_hotpepper": (search_hotpepper, query_params_model(search_hotpepper), False),
+    "/api/nearby_spots": (nearby_spots, NearbyRequest, True),
+    "/api/local_hotels": (local_hotels, LocalHotelSearchRequest, True),
+    "/api/search_hotels_vacant": (search_hotels_vacant, VacantSearchRequest, True),
+    "/api/hotels_availability": (hotels_availability, BatchAvailabilityRequest, True),
+}
 
+def batch_sub_request_scope(path: str, parent: Request) -> Request:
+    """サブリクエスト用の擬似Request。Accept-Encoding / If-None-Match を持たないので、
+    各エンドポイントは圧縮も304もしない素のJSONを返す (圧縮はバッチ全体で1回だけ行う)。
+    受付制御でクライアントを区別できるよう、接続元と X-Client-Id だけは引き継ぐ"""
+    headers = [(b"x-client-id", v.encode("latin-1")) for v in parent.headers.getlist("x-client-id")[:1]]
+    return Request({"type": "http", "method": "GET", "path": path, "headers": headers, "query_string": b"", "client": parent.scope.get("client")})
+
+async def run_batch_item(index: int, sub: BatchSubRequest, sem: asyncio.Semaphore, parent: Request) -> bytes:
+    """サブリクエスト1件を実行し、{"index", "status", "body"} をJSONバイト列で返す"""
+    def item(status: int, body: bytes) -> bytes:
+        return b'{"index":%d,"status":%d,"body":' % (index, status) + body + b"}"
+
+    endpoint = BATCH_ENDPOINTS.get(sub.path)
+    if endpoint is None: return item(404, dumps_json({"error": f"バッチ非対応のパスです: {sub.path}"}))
+    handler, model, is_body = endpoint
+    try:
+        validated = model(**sub.params)
+    except ValidationError as e:
+        return item(422, dumps_json({"error": "パラメータが不正です。", "detail": e.errors(include_url=False, include_context=False)}))
+
+    kwargs = {"req": validated} if is_body else validated.model_dump()
+    if "request" in inspect.signature(handler).parameters: kwargs["request"] = batch_sub_request_scope(sub.path, parent)
+    try:
+        async with sem:
+            result = await handler(**kwargs)
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
-        print(f"Hotpepper Search Error: {e}")
-        return {"results": []}
+        print(f"Batch Item Error ({sub.path}): {e}")
+        return item(500, dumps_json({"error": f"システムエラー: {str(e)}"}))
+    # 既にエンコード済みのレスポンスはデコードせずにそのまま埋め込む
+    if isinstance(result, Response): return item(result.status_code, bytes(result.body))
+    return item(200, dumps_json(result))
+
+@app.post("/api/batch")
+async def batch(req: BatchRequest, request: Request):
+    """複数の読み取り系APIを同時実行し、結果をリクエスト順 (stream時は完了順のNDJSON) で返す"""
+    if len(req.requests) > BATCH_MAX_REQUESTS:
+        return JSONResponse({"error": f"一度に実行できるのは{BATCH_MAX_REQUESTS}件までです。"}, status_code=400)
+    sem = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    if req.stream:
+        async def generate():
+            with ClientTaskScope(request) as scope:
+                tasks = [scope.spawn(run_batch_item(i, sub, sem, request)) for i, sub in enumerate(req.requests)]
+                for future in asyncio.as_completed(tasks):
+                    yield await future + b"\n"
+        return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+    with ClientTaskScope(request) as scope:
+        items = await asyncio.gather(*[scope.spawn(run_batch_item(i, sub, sem, request)) for i, sub in enumerate(req.requests)])
+    return json_bytes_response(b'{"results":[' + b",".join(items) + b"]}", request)
+
+# ==========================================
+# 🩺 管理用: イベントループ監視とプロファイラ
+# ==========================================
+def admin_denied(request: Request) -> Optional[Response]:
+    """X-Admin-Token を検証する。ADMIN_TOKEN 未設定なら存在しないものとして404を返す"""
+    if not ADMIN_TOKEN: return JSONResponse({"detail": "Not Found"}, status_code=404)
+    if not hmac.compare_digest(request.headers.get("x-admin-token", ""), ADMIN_TOKEN):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    return None
+
+@app.get("/admin/loop_lag")
+async def admin_loop_lag(request: Request):
+    """最大遅延と最近のループ停止 (停止した瞬間のスタック付き)"""
+    denied = admin_denied(request)
+    if denied: return denied
+    return loop_monitor.snapshot()
+
+@app.get("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 10.0, interval_ms: float = 5.0, all_threads: bool = False):
+    """seconds 秒間サンプリングし、collapsed形式 (flamegraph.pl / speedscope で読める) のテキストを返す"""
+    denied = admin_denied(request)
+    if denied: return denied
+    if profile_lock.locked(): return JSONResponse({"error": "別のプロファイルを実行中です。"}, status_code=409)
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    async with profile_lock:
+        profiler = await run_profiler(seconds, max(interval_ms, 1.0) / 1000.0, None if all_threads else loop_thread_id)
+    return Response(content=profiler.collapsed(), media_type="text/plain; charset=utf-8",
+                    headers={"X-Profile-Samples": str(profiler.sample_count), "Cache-Control": "no-store"})
+
 @app.get("/")
 async def root():
-    return {"status": "ok", "message": "Backend is awake and running."}
\ No newline at end of file
+    return {"status": "ok", "message": "Backend is awake and running."}
+
+@app.get("/ready")
+async def ready():
+    """ウォームアップ完了まで503を返す (プロキシのヘルスチェック用。生存確認は / を使う)"""
+    body = {"status": "ready" if startup_state["ready"] else "warming", "timings_ms": startup_state["timings_ms"],
+            "hot_cache_entries": len(hot_cache), "place_index_entries": len(place_index)}
+    return FastJSONResponse(body, status_code=200 if startup_state["ready"] else 503)